@@ -0,0 +1,221 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the block write and read paths.
+#
+# Data goes through File, Message and IMAPEnc against an in-memory mailbox,
+# so only local work is measured. Each pass runs in its own process and
+# reports throughput and its peak memory above the starting point. The peak,
+# in units of the block size, is the number of block-sized copies that were
+# alive at once. The bytes copied per MiB count every buffer the methods in
+# COPYING_METHODS make, and the bytes written into existing ones. Copies
+# made in worker processes are not counted.
+#
+# Usage: python -m imapfs.bench [-s MEGABYTES] [-c] [-j WORKERS [-p]]
+
+import optparse
+import os
+import resource
+import time
+import uuid
+
+from imapfs import debug_print, file, imapenc, message, metrics, pipeline
+
+
+# Size of the reads and writes, like the ones FUSE makes
+IO_SIZE = 131072
+
+# Methods that return a new buffer, which is counted as copied
+COPYING_METHODS = [
+    (imapenc.IMAPEnc, "compress"), (imapenc.IMAPEnc, "decompress"),
+    (imapenc.IMAPEnc, "encode"), (imapenc.IMAPEnc, "decode"),
+    (imapenc.IMAPEnc, "encrypt"), (imapenc.IMAPEnc, "decrypt"),
+    (imapenc.IMAPEnc, "pad"), (imapenc.IMAPEnc, "crypt_chunk"),
+    (imapenc.IMAPEnc, "encrypt_chunks"), (imapenc.IMAPEnc, "decrypt_chunks"),
+    (file.File, "read")]
+
+
+class LoopbackConnection:
+  """Stands in for IMAPConnection, keeping encrypted messages in memory
+  With keep set to False, messages are encrypted and then dropped
+  """
+
+  def __init__(self, enc, keep=True):
+    self.enc = enc
+    self.keep = keep
+    self.messages = {}
+
+  def new_block_name(self):
+    return str(uuid.uuid4())
+
+  def get_uid_by_subject(self, subject):
+    if subject in self.messages:
+      return subject
+    return None
+
+  def get_message(self, uid, encrypted=True):
+    if not encrypted:
+      return self.messages[uid]
+    return self.enc.decrypt_message(self.messages[uid])
+
+  def get_messages(self, uids, encrypted=True):
+    return dict([(uid, self.get_message(uid, encrypted)) for uid in uids if uid in self.messages])
+
+  def put_message(self, subject, data, encrypted=True):
+    enc_data = data
+    if encrypted:
+      enc_data = self.enc.encrypt_message(data)
+    if self.keep:
+      self.messages[subject] = enc_data
+
+  def delete_message(self, uid):
+    pass
+
+
+def count_result(method):
+  """Wrap a method to count the size of its result as copied
+  """
+  def counted(*args, **kwargs):
+    result = method(*args, **kwargs)
+    metrics.add("copied_bytes", len(result))
+    return result
+  return counted
+
+
+def count_copies():
+  """Count the bytes copied by the block paths in the copied_bytes counter
+  """
+  for cls, name in COPYING_METHODS:
+    setattr(cls, name, count_result(getattr(cls, name)))
+
+  # Writes copy into the message's buffer, which may be a copy itself
+  write = message.Message.write
+  make_writable = message.Message.make_writable
+
+  def counted_write(self, buf):
+    metrics.add("copied_bytes", len(buf))
+    write(self, buf)
+
+  def counted_make_writable(self):
+    data = self.data
+    make_writable(self)
+    if self.data is not data:
+      metrics.add("copied_bytes", len(self.data))
+
+  message.Message.write = counted_write
+  message.Message.make_writable = counted_make_writable
+
+
+def get_rss():
+  """Get the current resident set size in bytes
+  """
+  f = open("/proc/self/statm")
+  try:
+    pages = int(f.read().split()[1])
+  finally:
+    f.close()
+  return pages * resource.getpagesize()
+
+
+def get_peak_rss():
+  """Get the peak resident set size in bytes
+  """
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def write_file(conn, data):
+  """Write data to a new file
+  """
+  f = file.File.create(conn)
+  view = memoryview(data)
+  for offset in range(0, len(data), IO_SIZE):
+    f.seek(offset)
+    f.write(view[offset:offset + IO_SIZE])
+  f.close()
+  return f
+
+
+def read_file(f):
+  """Read a file back
+  """
+  for offset in range(0, f.size, IO_SIZE):
+    f.seek(offset)
+    data = str(f.read(IO_SIZE))
+    # IMAPFS.read hands FUSE a str the same way
+    metrics.add("copied_bytes", len(data))
+  f.close_blocks()
+
+
+def measure(name, func, size):
+  """Run func in a child process and print its throughput, peak memory and
+  bytes copied
+  """
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    count_copies()
+    start_rss = get_rss()
+    start_copied = metrics.get("copied_bytes")
+    start_time = time.time()
+    func()
+    result = "%f %d %d" % (time.time() - start_time, get_peak_rss() - start_rss,
+                           metrics.get("copied_bytes") - start_copied)
+    os.write(write_fd, result)
+    os._exit(0)
+
+  os.close(write_fd)
+  result = os.read(read_fd, 100)
+  os.close(read_fd)
+  os.waitpid(pid, 0)
+
+  elapsed, peak, copied = result.split()
+  elapsed, peak, copied = float(elapsed), int(peak), int(copied)
+  megabytes = float(size) / 1048576
+  print "%s: %.1f MiB in %.2fs (%.2f MiB/s), peak +%.1f MiB (%.1f blocks), copied %.1f MiB per MiB" % (
+      name, megabytes, elapsed, megabytes / elapsed, float(peak) / 1048576,
+      float(peak) / file.FS_BLOCK_SIZE, float(copied) / size)
+
+
+def main():
+  parser = optparse.OptionParser(usage="python -m imapfs.bench [options]")
+  parser.add_option("-s", "--size", type="int", default=16, help="Megabytes to transfer [default: %default]")
+  parser.add_option("-c", "--compressible", action="store_true", help="Use compressible data instead of random data")
+  parser.add_option("-j", "--workers", type="int", default=0, help="Number of pipeline workers, 0 to work inline [default: %default]")
+  parser.add_option("-p", "--processes", action="store_true", help="Compress on worker processes instead of threads")
+  options, args = parser.parse_args()
+
+  debug_print.enabled = False
+  if options.workers:
+    file.File.pipeline = pipeline.Pipeline(options.workers, options.processes)
+
+  size = options.size * 1048576
+  if options.compressible:
+    data = bytearray("".join(["line %d\n" % i for i in xrange(size / 8)])[:size])
+  else:
+    data = bytearray(os.urandom(size))
+
+  enc = imapenc.IMAPEnc("bench", 1)
+
+  measure("write", lambda: write_file(LoopbackConnection(enc, keep=False), data), size)
+
+  # Reads need the written messages, so write again in this process
+  f = write_file(LoopbackConnection(enc), data)
+  measure("read", lambda: read_file(f), size)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,280 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Bulk import and export without going through FUSE.
+#
+# Blocks are compressed, encrypted and uploaded (or downloaded, decrypted
+# and decompressed) by worker threads, each with its own connection, while
+# the main thread walks the tree. Metadata is written once at the end.
+# The filesystem must not be mounted while this runs.
+#
+# Usage: python -m imapfs.bulk [options] put LOCAL_PATH REMOTE_DIR
+#        python -m imapfs.bulk [options] get REMOTE_PATH LOCAL_PATH
+
+import optparse
+import os
+import Queue
+import threading
+import time
+
+from imapfs import debug_print, directory, file, filesystem
+
+
+# Bytes of blocks each download job fetches with one command
+FETCH_BATCH_SIZE = 4194304
+
+
+class Workers:
+  """Threads that each run jobs on their own connection
+  """
+
+  def __init__(self, options, enc, count, func):
+    self.func = func
+    self.queue = Queue.Queue(count * 2)
+    self.errors = []
+    self.threads = []
+    for i in range(count):
+      conn = filesystem.connect(options, enc)
+      thread = threading.Thread(target=self.run, args=(conn,))
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def run(self, conn):
+    """Run jobs until told to stop
+    """
+    while True:
+      job = self.queue.get()
+      if job is None:
+        break
+      try:
+        self.func(conn, *job)
+      except Exception, e:
+        self.errors.append(e)
+    conn.logout()
+
+  def put(self, *job):
+    """Queue a job
+    Blocks while the queue is full, which bounds the memory in flight
+    """
+    if self.errors:
+      raise self.errors[0]
+    self.queue.put(job)
+
+  def finish(self):
+    """Wait for all jobs to finish
+    """
+    for thread in self.threads:
+      self.queue.put(None)
+    for thread in self.threads:
+      thread.join()
+    if self.errors:
+      raise self.errors[0]
+
+
+def upload_block(conn, name, data, compress):
+  """Compress if asked to, encrypt and store a block
+  """
+  if compress:
+    data = conn.enc.compress(data)
+  conn.put_message(name, data)
+
+
+def download_blocks(conn, path, blocks):
+  """Fetch blocks with one command and write them into a local file
+  blocks is a list of (name, offset, compressed) tuples
+  """
+  uids = [conn.get_uid_by_subject(name) for name, offset, compressed in blocks]
+  fetched = conn.get_messages(uids)
+  f = open(path, "r+b")
+  try:
+    for uid, (name, offset, compressed) in zip(uids, blocks):
+      if uid not in fetched:
+        raise IOError("Block %s not found" % name)
+      data = fetched.pop(uid)
+      if compressed:
+        data = conn.enc.decompress(data)
+      f.seek(offset)
+      f.write(data)
+  finally:
+    f.close()
+
+
+class Importer:
+  """Copies a local tree into the filesystem
+  """
+
+  def __init__(self, conn, workers):
+    self.conn = conn
+    self.workers = workers
+    self.nodes = []
+    self.bytes = 0
+
+  def put_file(self, path, node_hints):
+    """Upload a file
+    node_hints are the hints of the directory it goes in, which choose its
+    block size and codec like they do for files created through FUSE.
+    Returns the new File, its manifest is not written yet
+    """
+    node = file.File.create(self.conn, node_hints)
+    codec = node.get_codec()
+    f = open(path, "rb")
+    try:
+      block_id = 0
+      while True:
+        data = f.read(node.block_size)
+        if not data:
+          break
+        # Blocks of zeros are left as holes
+        if data.count("\0") != len(data):
+          name = self.conn.new_block_name()
+          node.blocks[block_id] = name
+          node.codecs[block_id] = codec
+          self.workers.put(name, data, codec == file.CODEC_BZ2)
+        node.size += len(data)
+        self.bytes += len(data)
+        block_id += 1
+    finally:
+      f.close()
+
+    self.nodes.append(node)
+    return node
+
+  def put_dir(self, path, node_hints):
+    """Upload a directory and everything in it
+    node_hints are the hints of the directory it goes in
+    Returns the new Directory
+    """
+    node = directory.Directory.create(self.conn, node_hints)
+    for name in sorted(os.listdir(path)):
+      child_path = os.path.join(path, name)
+      if os.path.isdir(child_path):
+        child = self.put_dir(child_path, node.hints)
+      elif os.path.isfile(child_path):
+        child = self.put_file(child_path, node.hints)
+      else:
+        continue
+      child.parent = node
+      node.add_child(child.message.name, name, child.get_attrs())
+
+    self.nodes.append(node)
+    return node
+
+  def put(self, local_path, parent):
+    """Upload local_path into the directory parent
+    """
+    name = os.path.basename(os.path.normpath(local_path))
+    if parent.get_child_by_name(name):
+      raise Exception("%s already exists" % name)
+
+    if os.path.isdir(local_path):
+      node = self.put_dir(local_path, parent.hints)
+    else:
+      node = self.put_file(local_path, parent.hints)
+
+    # All blocks must be stored before any metadata refers to them
+    self.workers.finish()
+
+    # Children first, so the new tree shows up all at once
+    for child in self.nodes:
+      child.flush()
+    parent.add_child(node.message.name, name, node.get_attrs())
+    parent.flush()
+
+
+class Exporter:
+  """Copies part of the filesystem to a local tree
+  """
+
+  def __init__(self, conn, workers):
+    self.conn = conn
+    self.workers = workers
+    self.bytes = 0
+
+  def get_file(self, node, path):
+    """Download a file
+    Holes are left unwritten, making the local file sparse
+    """
+    f = open(path, "wb")
+    try:
+      f.truncate(node.size)
+    finally:
+      f.close()
+
+    blocks = [(block_key, block_id * node.block_size, node.is_compressed(block_id))
+              for block_id, block_key in sorted(node.blocks.items())]
+    per_job = max(FETCH_BATCH_SIZE / node.block_size, 1)
+    for i in range(0, len(blocks), per_job):
+      self.workers.put(path, blocks[i:i + per_job])
+    self.bytes += node.size
+
+  def get_dir(self, node, path):
+    """Download a directory and everything in it
+    """
+    if not os.path.isdir(path):
+      os.mkdir(path)
+    for child_key, child_name in node.children.items():
+      self.get(filesystem.open_node(self.conn, child_key), os.path.join(path, child_name))
+
+  def get(self, node, path):
+    """Download a node to path
+    """
+    if node.__class__ == directory.Directory:
+      self.get_dir(node, path)
+    else:
+      self.get_file(node, path)
+
+
+def main():
+  parser = optparse.OptionParser(usage="python -m imapfs.bulk [options] put LOCAL_PATH REMOTE_DIR\n"
+                                       "       python -m imapfs.bulk [options] get REMOTE_PATH LOCAL_PATH")
+  filesystem.add_connection_options(parser)
+  parser.add_option("-j", "--jobs", type="int", default=4, help="Number of parallel transfers [default: %default]")
+  parser.add_option("-v", "--verbose", action="store_true", help="Print debug output")
+  options, args = parser.parse_args()
+  if len(args) != 3 or args[0] not in ("put", "get"):
+    parser.error("expected put or get and two paths")
+
+  debug_print.enabled = options.verbose
+
+  conn = filesystem.connect(options)
+  start_time = time.time()
+
+  if args[0] == "put":
+    parent = filesystem.get_node_by_path(conn, args[2])
+    if parent.__class__ != directory.Directory:
+      parser.error("%s is not a directory" % args[2])
+    workers = Workers(options, conn.enc, options.jobs, upload_block)
+    transfer = Importer(conn, workers)
+    transfer.put(args[1], parent)
+  else:
+    node = filesystem.get_node_by_path(conn, args[1])
+    if not node:
+      parser.error("%s not found" % args[1])
+    workers = Workers(options, conn.enc, options.jobs, download_blocks)
+    transfer = Exporter(conn, workers)
+    transfer.get(node, args[2])
+    workers.finish()
+
+  elapsed = time.time() - start_time
+  megabytes = float(transfer.bytes) / 1048576
+  print "Transferred %.1f MiB in %.2fs (%.2f MiB/s)" % (megabytes, elapsed, megabytes / max(elapsed, 0.001))
+
+  conn.logout()
+
+
+if __name__ == "__main__":
+  main()
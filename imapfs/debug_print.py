@@ -14,5 +14,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Set to False to silence debug output
+enabled = True
+
 def debug_print(stuff):
-  print stuff
+  if enabled:
+    print stuff
@@ -16,33 +16,59 @@
 
 import time
 
-from imapfs import message
+from imapfs import hints, message
 
 
 class Directory:
   """Represents a directory
-  Contains a list of file names
+  Contains a list of file names, and the type, size, ctime and mtime of
+  each child as of its last flush. Its hints are given to new children.
   """
 
-  def __init__(self, msg, ctime, mtime, children):
+  def __init__(self, msg, ctime, mtime, children, attrs=None, hints=None):
     self.message = msg
     self.ctime = ctime
     self.mtime = mtime
     self.children = children
+    self.attrs = attrs or {}
+    self.hints = hints or {}
     self.dirty = False
 
-  def add_child(self, key, name):
+    # Entries as last stored. The mtime only changes with the entries, not
+    # with the attributes of children.
+    self.stored_children = dict(children)
+
+    # Directory this one was opened from, told about changes on flush
+    self.parent = None
+
+  def get_attrs(self):
+    """Get the attributes stored in the parent's entry
+    """
+    return ("d", 0, int(self.ctime), int(self.mtime))
+
+  def add_child(self, key, name, attrs=None):
     """Add a child to this directory
     """
     self.children[key] = name
+    if attrs:
+      self.attrs[key] = attrs
     self.dirty = True
 
+  def update_child(self, key, attrs):
+    """Update the stored attributes of a child
+    """
+    if key in self.children and self.attrs.get(key) != attrs:
+      self.attrs[key] = attrs
+      self.dirty = True
+
   def remove_child(self, key):
     """Remove a child by key from this dir
     """
     if key not in self.children:
       return
     self.children.pop(key)
+    if key in self.attrs:
+      self.attrs.pop(key)
     self.dirty = True
 
   def get_child_by_name(self, name):
@@ -57,13 +83,21 @@ class Directory:
     """Writes the changes to the server
     """
     if self.dirty:
-      self.mtime = time.time()
+      if self.children != self.stored_children:
+        self.mtime = time.time()
       self.message.truncate(0)  # clear
-      self.message.write("d\r\n%d\t%d\r\n" % (self.ctime, self.mtime))
+      self.message.write("d\r\n%d\t%d%s\r\n" % (self.ctime, self.mtime, hints.format(self.hints)))
       for child_key, child_name in self.children.items():
-        self.message.write("%s\t%s\r\n" % (child_key, child_name))
+        if child_key in self.attrs:
+          self.message.write("%s\t%s\t%s\t%d\t%d\t%d\r\n" % ((child_key, child_name) + self.attrs[child_key]))
+        else:
+          self.message.write("%s\t%s\r\n" % (child_key, child_name))
       self.message.flush()
       self.dirty = False
+      self.stored_children = dict(self.children)
+
+      if self.parent:
+        self.parent.update_child(self.message.name, self.get_attrs())
 
   def close(self):
     """Close
@@ -73,11 +107,12 @@ class Directory:
     self.message.close()
 
   @staticmethod
-  def create(conn):
+  def create(conn, node_hints=None):
     """Create a directory
+    node_hints are the hints of the directory it is created in
     """
     msg = message.Message.create(conn)
-    d = Directory(msg, time.time(), time.time(), {})
+    d = Directory(msg, time.time(), time.time(), {}, hints=dict(node_hints or {}))
     d.dirty = True
     return d
 
@@ -85,18 +120,22 @@ class Directory:
   def from_message(msg):
     """Create a directory object from a message
     """
-    data = str(msg.read())
+    data = msg.read().tobytes()
 
     lines = data.split("\r\n")
     info = lines[1].split("\t")
 
     children = {}
+    attrs = {}
     for line in lines[2:]:
       if not line:
         continue
       line_info = line.split("\t")
       children[line_info[0]] = line_info[1]
+      # Entries written before attributes were stored only have a name
+      if len(line_info) >= 6:
+        attrs[line_info[0]] = (line_info[2], int(line_info[3]), int(line_info[4]), int(line_info[5]))
 
-    d = Directory(msg, int(info[0]), int(info[1]), children)
+    d = Directory(msg, int(info[0]), int(info[1]), children, attrs, hints.parse(info[2:]))
     return d
 
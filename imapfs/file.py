@@ -14,120 +14,322 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import itertools
 import os
 import time
-import uuid
 
-from imapfs import message
+from imapfs import hints, message, pipeline
 from imapfs.debug_print import debug_print
 
 
+# Block size of files written before it was stored in the manifest
 FS_BLOCK_SIZE = 262144
 
+# How blocks are stored
+CODEC_BZ2 = "bz2"
+CODEC_NONE = "none"
+
+# Reads up to this fraction of the block size from a block that is not open
+# and not compressed fetch only the part they need
+RANGE_READ_FRACTION = 4
+
 class File:
   """Represents a file
   """
-  def __init__(self, msg, ctime, mtime, size, blocks):
+
+  # Number of blocks each open file keeps in memory
+  working_set_size = 8
+
+  # Pipeline that encodes and decodes blocks, None to do it inline
+  pipeline = None
+
+  # RefTable of blocks shared with clones, None if nothing is shared
+  refs = None
+
+  # Codec of new blocks
+  codec = CODEC_BZ2
+
+  # Block size of new files
+  new_block_size = FS_BLOCK_SIZE
+
+  # Directory to keep open blocks in, memory-mapped, None to keep them on
+  # the heap
+  spool_dir = None
+
+  def __init__(self, msg, ctime, mtime, size, blocks, codecs=None, block_size=FS_BLOCK_SIZE, hints=None):
     self.message = msg
     self.ctime = ctime
     self.mtime = mtime
     self.size = size
     self.blocks = blocks
+    self.codecs = codecs or {}
+    self.block_size = block_size
+    self.hints = hints or {}
     self.dirty = False
 
+    # Directory this file was opened from, told about changes on flush
+    self.parent = None
+
     self.pos = 0
 
-    self.open_messages = {}
+    # Open blocks, least recently used first
+    self.open_messages = collections.OrderedDict()
+
+    # Stored blocks this file no longer lists, released once a manifest
+    # without them is stored
+    self.released_blocks = []
+
+  def add_block(self, block_id, block):
+    """Add a block to the working set
+    The least recently used blocks are written back and dropped to make room,
+    unless the file is pinned
+    """
+    while len(self.open_messages) >= max(self.working_set_size, 1) and not self.is_pinned():
+      old_block_id = next(iter(self.open_messages))
+      # Write back the other changed blocks along with it, so the
+      # pipeline can encode them in parallel
+      if self.pipeline and self.open_messages[old_block_id].dirty:
+        self.flush_blocks()
+      self.close_block(old_block_id)
+    if self.spool_dir:
+      block.use_spool(self.spool_dir)
+    self.open_messages[block_id] = block
+
+  def get_codec(self):
+    """Get the codec of blocks written to this file
+    """
+    return self.hints.get("codec", self.codec)
+
+  def get_prefetch(self):
+    """Get the number of blocks to fetch past the end of each read
+    """
+    return int(self.hints.get("prefetch", 0))
+
+  def is_pinned(self):
+    """Check if the open blocks of this file are kept until unmount
+    """
+    return self.hints.get("pin") == "1"
+
+  def set_block_size(self, block_size):
+    """Change the block size
+    Returns False if the file already has blocks
+    """
+    if self.blocks or self.open_messages:
+      return False
+    if block_size != self.block_size:
+      self.block_size = block_size
+      self.dirty = True
+    return True
+
+  def get_attrs(self):
+    """Get the attributes stored in the parent's entry
+    """
+    return ("f", self.size, int(self.ctime), int(self.mtime))
 
   def create_block(self, block_id):
     """Create a block
+    It is added to the file once it is written
     """
-    name = str(uuid.uuid4())
+    name = self.message.conn.new_block_name()
     block = message.Message(self.message.conn, name, "")
     block.dirty = True
-    block.compress = True
-    self.blocks[block_id] = block.name
-    self.open_messages[block_id] = block
+    block.compress = self.get_codec() == CODEC_BZ2
+    self.add_block(block_id, block)
     self.dirty = True
     return block
 
-  def open_block(self, block_id):
+  def open_block(self, block_id, create=False):
     """Open a block
+    Blocks missing from the file are holes. Returns None for a hole, unless
+    create is set.
     """
     if block_id in self.open_messages:
-      return self.open_messages[block_id]
+      # Mark as most recently used
+      block = self.open_messages.pop(block_id)
+      self.open_messages[block_id] = block
+      return block
     else:
-      debug_print("Opening block %d" % block_id)
       if block_id not in self.blocks:
+        if not create:
+          return None
         # Create first
+        debug_print("Creating block %d" % block_id)
         block = self.create_block(block_id)
         return block
       else:
+        debug_print("Opening block %d" % block_id)
         block_key = self.blocks[block_id]
-        msg = message.Message.open(self.message.conn, block_key, compressed=True)
-        self.open_messages[block_id] = msg
+        msg = message.Message.open(self.message.conn, block_key, compressed=self.is_compressed(block_id))
+        self.add_block(block_id, msg)
         return msg
 
+  def get_range_read_limit(self):
+    """Get the largest read that fetches only part of a block
+    """
+    return self.block_size / RANGE_READ_FRACTION
+
+  def is_compressed(self, block_id):
+    """Check if a stored block is compressed
+    """
+    return self.codecs.get(block_id, CODEC_BZ2) == CODEC_BZ2
+
+  def copy_on_write(self, block_id, block):
+    """Give an open block that is shared with other files a name of its own
+    Called before the block changes. The shared block is released once the
+    copy is stored.
+    """
+    if self.refs and block.name == self.blocks.get(block_id) and self.refs.is_shared(block.name):
+      debug_print("Copying shared block %d" % block_id)
+      block.name = self.message.conn.new_block_name()
+      block.dirty = True
+
+  def release_block(self, block_key):
+    """Drop this file's reference to a stored block
+    Without refs, the block is deleted at once. Otherwise the reference is
+    dropped after the manifest is next written, and the block is deleted
+    unless other files still list it.
+    """
+    if self.refs is None:
+      message.Message.unlink(self.message.conn, block_key)
+    else:
+      self.released_blocks.append(block_key)
+
+  def apply_releases(self):
+    """Drop the references in released_blocks, and write refs
+    """
+    for block_key in self.released_blocks:
+      if self.refs.release(block_key):
+        message.Message.unlink(self.message.conn, block_key)
+    self.released_blocks = []
+    self.refs.flush()
+
+  def read_block_range(self, block_id, offset, size):
+    """Read part of a block without opening it
+    Only works for uncompressed blocks. Returns None if the block has to be
+    opened instead.
+    """
+    if size > self.get_range_read_limit() or self.is_compressed(block_id):
+      return None
+    if block_id in self.open_messages or block_id not in self.blocks:
+      return None
+
+    conn = self.message.conn
+    debug_print("Reading %d bytes of block %d" % (size, block_id))
+    return conn.get_message_range(conn.get_uid_by_subject(self.blocks[block_id]), offset, size)
+
+  def load_blocks(self, block_ids):
+    """Open several blocks at once
+    Blocks are fetched with one command, then decoded by the pipeline, if
+    any. Holes and blocks that are already open or missing on the server
+    are skipped.
+    """
+    conn = self.message.conn
+    block_ids = [block_id for block_id in block_ids
+                 if block_id in self.blocks and block_id not in self.open_messages]
+    if not self.is_pinned():
+      block_ids = block_ids[:self.working_set_size]
+    if len(block_ids) < 2:
+      return
+
+    uids = dict([(block_id, conn.get_uid_by_subject(self.blocks[block_id])) for block_id in block_ids])
+    fetched = conn.get_messages(uids.values(), encrypted=False)
+    loaded = [block_id for block_id in block_ids if uids[block_id] in fetched]
+
+    jobs = [(conn.enc, fetched.pop(uids[block_id]), self.is_compressed(block_id)) for block_id in loaded]
+    if self.pipeline:
+      decoded = self.pipeline.decode(jobs)
+    else:
+      decoded = itertools.starmap(pipeline.decode_block, jobs)
+    for block_id, data in itertools.izip(loaded, decoded):
+      debug_print("Loaded block %d" % block_id)
+      msg = message.Message(conn, self.blocks[block_id], data)
+      msg.compress = self.is_compressed(block_id)
+      self.add_block(block_id, msg)
+
+  def flush_block(self, block_id, encoded=None):
+    """Write changes to a block to the server
+    A block of only zeros is turned into a hole instead of being stored.
+    encoded is the block already compressed and encrypted, if any.
+    """
+    block = self.open_messages[block_id]
+    if not block.dirty:
+      return
+
+    if block.is_zero():
+      debug_print("Block %d is empty, leaving a hole" % block_id)
+      if block_id in self.blocks:
+        self.release_block(self.blocks.pop(block_id))
+        self.codecs.pop(block_id, None)
+        self.dirty = True
+      block.dirty = False
+    else:
+      codec = CODEC_BZ2 if block.compress else CODEC_NONE
+      if self.blocks.get(block_id) != block.name or self.codecs.get(block_id) != codec:
+        # A copy of a shared block replaces it
+        if block_id in self.blocks and self.blocks[block_id] != block.name:
+          self.release_block(self.blocks[block_id])
+        self.blocks[block_id] = block.name
+        self.codecs[block_id] = codec
+        self.dirty = True
+      block.flush(encoded)
+
   def close_block(self, block_id):
     """Close a block
     """
     if block_id not in self.open_messages:
       return
     debug_print("Closing open block %d" % block_id)
-    self.open_messages[block_id].close()
+    self.flush_block(block_id)
     self.open_messages.pop(block_id)
 
   def delete_block(self, block_id):
     """Delete a block
+    Any unwritten changes to it are dropped
     """
+    if block_id in self.open_messages:
+      self.open_messages.pop(block_id)
     if block_id not in self.blocks:
       return
-    if block_id in self.open_messages:
-      self.close_block(block_id)
 
     # Delete
-    message.Message.unlink(self.message.conn, self.blocks[block_id])
-    self.blocks.pop(block_id)
+    self.release_block(self.blocks.pop(block_id))
+    self.codecs.pop(block_id, None)
     self.dirty = True
 
   def truncate(self, size=None):
     """Resize the file
+    Growing the file only changes its size, the new space is a hole
     """
     if size is None:
       return
 
-    self.size = size
-
-    # Close and delete truncated blocks
-    end_block = self.size / FS_BLOCK_SIZE
-    for block_id in self.blocks:
-      if block_id > end_block:
+    # Delete blocks past the end
+    for block_id in set(self.blocks.keys() + self.open_messages.keys()):
+      if block_id * self.block_size >= size:
         self.delete_block(block_id)
-        # We leave the entire last block intact, even if it got trimmed a little
 
+    # Cut the last block short, so the cut off part reads as zeros
+    # if the file grows again
+    if size < self.size and size % self.block_size:
+      block = self.open_block(size / self.block_size)
+      if block and len(block.data) > size % self.block_size:
+        self.copy_on_write(size / self.block_size, block)
+        block.truncate(size % self.block_size)
+
+    self.size = size
     self.dirty = True
 
   def seek(self, offset, whence=os.SEEK_SET):
     """Seek to an offset in the file
+    Open blocks stay in the working set
     """
-    old_pos = self.pos
     if whence == os.SEEK_SET:
-      new_pos = offset
+      self.pos = offset
     elif whence == os.SEEK_CUR:
-      new_pos = old_pos + offset
+      self.pos += offset
     elif whence == os.SEEK_END:
-      new_pos = self.size - offset
-
-    # Get block we are moving from and to
-    old_block_id = old_pos / FS_BLOCK_SIZE
-    new_block_id = new_pos / FS_BLOCK_SIZE
-
-    # If we exit a block into a new one, we close the old block
-    # to write changes and free memory
-    if old_block_id != new_block_id and old_block_id in self.open_messages:
-      self.close_block(old_block_id)
-
-    self.pos = new_pos
+      self.pos = self.size - offset
 
   def read(self, size):
     """Read a set of bytes from a file
@@ -135,30 +337,51 @@ class File:
     """
     # read only as much as is available
     if self.pos + size > self.size:
-      size = self.size - self.pos
+      size = max(self.size - self.pos, 0)
 
     # Get block the start point and end points are in
-    start_block_id = self.pos / FS_BLOCK_SIZE
-    end_block_id = (self.pos + size) / FS_BLOCK_SIZE + 1
-
-    buf = bytearray()
+    start_block_id = self.pos / self.block_size
+    end_block_id = (self.pos + size + self.block_size - 1) / self.block_size
+
+    # Fetch whole blocks with one command if they have to be decoded
+    # anyway. Small reads of uncompressed blocks fetch only what they need,
+    # unless the file asks for the blocks after them too.
+    prefetch = self.get_prefetch()
+    whole_blocks = range(start_block_id, end_block_id)
+    if size <= self.get_range_read_limit() and not prefetch:
+      whole_blocks = [i for i in whole_blocks if self.is_compressed(i)]
+    last_block_id = (self.size + self.block_size - 1) / self.block_size
+    whole_blocks += range(end_block_id, min(end_block_id + prefetch, last_block_id))
+    self.load_blocks(whole_blocks)
+
+    # Blocks are read straight into the zeroed result
+    buf = bytearray(size)
+    view = memoryview(buf)
+    read_offset = 0
 
     # For each block containing data we need
     for i in range(start_block_id, end_block_id):
       # Where in this block does the data start?
-      current_block_offset = self.pos % FS_BLOCK_SIZE
+      current_block_offset = self.pos % self.block_size
       # How much data can we read out of this block?
-      read_size = FS_BLOCK_SIZE - current_block_offset
+      read_size = self.block_size - current_block_offset
 
       # Read only as much as we need
-      if len(buf) + read_size > size:
-        read_size = size - len(buf)
+      if read_offset + read_size > size:
+        read_size = size - read_offset
 
       # Open block, seek to position, read
-      block = self.open_block(i)
-      block.seek(current_block_offset)
+      # Holes and data past the end of a block read as zeros
+      data = self.read_block_range(i, current_block_offset, read_size)
+      if data is not None:
+        view[read_offset:read_offset + len(data)] = data
+      else:
+        block = self.open_block(i)
+        if block:
+          block.seek(current_block_offset)
+          block.readinto(view[read_offset:read_offset + read_size])
 
-      buf += block.read(read_size)
+      read_offset += read_size
 
       # Update seek position.
       self.seek(read_size, os.SEEK_CUR)
@@ -174,30 +397,33 @@ class File:
       self.truncate(self.pos + size)
 
     # Determine starting and ending blocks
-    start_block_id = self.pos / FS_BLOCK_SIZE
-    end_block_id = (self.pos + size) / FS_BLOCK_SIZE + 1
+    start_block_id = self.pos / self.block_size
+    end_block_id = (self.pos + size + self.block_size - 1) / self.block_size
 
     write_offset = 0
 
     # For each block we need to write to
     for i in range(start_block_id, end_block_id):
       # Find where our write starts in the current block
-      current_block_offset = self.pos % FS_BLOCK_SIZE
+      current_block_offset = self.pos % self.block_size
       # Figure out how much we can write in this block
-      write_size = FS_BLOCK_SIZE - current_block_offset
+      write_size = self.block_size - current_block_offset
       # Write only as much as in buf
       if write_size > size - write_offset:
         write_size = size - write_offset
 
-      # Open, seek, write.
-      block = self.open_block(i)
+      # Open, seek, write. Rewritten blocks take the file's codec, if
+      # it has one of its own.
+      block = self.open_block(i, create=True)
+      self.copy_on_write(i, block)
+      if "codec" in self.hints:
+        block.compress = self.hints["codec"] == CODEC_BZ2
       block.seek(current_block_offset)
       block.write(buf[write_offset:write_offset + write_size])
 
       write_offset += write_size
 
       # Update seek pos
-      # This also flushes/closes the open block if we are done
       self.seek(write_size, os.SEEK_CUR)
 
     self.dirty = True
@@ -208,21 +434,61 @@ class File:
     if self.dirty:
       self.mtime = time.time()
       self.message.truncate(0)
-      self.message.write("f\r\n%d\t%d\t%d\r\n" % (self.ctime, self.mtime, self.size))
+      self.message.write("f\r\n%d\t%d\t%d\t%d%s\r\n" % (self.ctime, self.mtime, self.size, self.block_size,
+                                                        hints.format(self.hints)))
       for block_id, block_key in self.blocks.items():
-        self.message.write("%d\t%s\r\n" % (block_id, block_key))
+        self.message.write("%d\t%s\t%s\r\n" % (block_id, block_key, self.codecs.get(block_id, CODEC_BZ2)))
 
       self.message.flush()
       self.dirty = False
 
+      # Blocks this file stopped listing can be released now
+      if self.refs:
+        self.apply_releases()
+
+      if self.parent:
+        self.parent.update_child(self.message.name, self.get_attrs())
+
+  def flush_blocks(self):
+    """Write back all changed blocks
+    They stay in the working set. With a pipeline, blocks are encoded by
+    its workers while earlier ones are uploaded.
+    """
+    block_ids = [block_id for block_id, block in self.open_messages.items() if block.dirty]
+    if self.pipeline is None or len(block_ids) < 2:
+      for block_id in block_ids:
+        self.flush_block(block_id)
+      return
+
+    # Blocks of zeros become holes and need no encoding
+    stored = []
+    for block_id in block_ids:
+      if self.open_messages[block_id].is_zero():
+        self.flush_block(block_id)
+      else:
+        stored.append(block_id)
+
+    enc = self.message.conn.enc
+    jobs = [(enc, self.open_messages[block_id].data, self.open_messages[block_id].compress)
+            for block_id in stored]
+    for block_id, encoded in itertools.izip(stored, self.pipeline.encode(jobs)):
+      self.flush_block(block_id, encoded)
+
+  def release_blocks(self):
+    """Write back all changed blocks, and close them unless the file is
+    pinned
+    """
+    if self.is_pinned():
+      self.flush_blocks()
+    else:
+      self.close_blocks()
+
   def close_blocks(self):
     """Closes all open blocks
     """
-    # Close all blocks
-    for block_id, block in self.open_messages.items():
-      debug_print("Closing open block %d" % block_id)
-      block.close()
-    self.open_messages = {}
+    debug_print("Closing %d open blocks" % len(self.open_messages))
+    self.flush_blocks()
+    self.open_messages = collections.OrderedDict()
 
   def close(self):
     """Close this file
@@ -238,17 +504,37 @@ class File:
     """
     # Delete all blocks
     for block_key in self.blocks.values():
-      message.Message.unlink(self.message.conn, block_key)
+      self.release_block(block_key)
 
     # Unlink own block
     message.Message.unlink(self.message.conn, self.message.name)
 
+    if self.refs:
+      self.apply_releases()
+
+  def clone(self):
+    """Create a copy of this file that shares its blocks
+    Changes to open blocks must be stored first. The references are added
+    to refs, but neither it nor the copy's manifest are written.
+    """
+    for block_key in self.blocks.values():
+      self.refs.add(block_key)
+
+    msg = message.Message.create(self.message.conn)
+    f = File(msg, time.time(), time.time(), self.size, dict(self.blocks), dict(self.codecs),
+             self.block_size, dict(self.hints))
+    f.dirty = True
+    return f
+
   @staticmethod
-  def create(conn):
+  def create(conn, node_hints=None):
     """Create a file
+    node_hints are the hints of the directory it is created in
     """
+    node_hints = dict(node_hints or {})
+    block_size = int(node_hints.pop("blocksize", File.new_block_size))
     msg = message.Message.create(conn)
-    f = File(msg, time.time(), time.time(), 0, {})
+    f = File(msg, time.time(), time.time(), 0, {}, block_size=block_size, hints=node_hints)
     f.dirty = True
     return f
 
@@ -256,19 +542,26 @@ class File:
   def from_message(msg):
     """Create a file object from a message
     """
-    data = str(msg.read())
+    data = msg.read().tobytes()
 
     lines = data.split("\r\n")
     info = lines[1].split("\t")
 
     blocks = {}
+    codecs = {}
 
     for line in lines[2:]:
       if not line:
         continue
       line_info = line.split("\t")
       blocks[int(line_info[0])] = line_info[1]
+      # Blocks written before codecs were recorded are compressed
+      if len(line_info) > 2:
+        codecs[int(line_info[0])] = line_info[2]
+
+    # Files written before block sizes were stored use the old fixed size
+    block_size = int(info[3]) if len(info) > 3 else FS_BLOCK_SIZE
 
-    f = File(msg, int(info[0]), int(info[1]), int(info[2]), blocks)
+    f = File(msg, int(info[0]), int(info[1]), int(info[2]), blocks, codecs, block_size, hints.parse(info[4:]))
     return f
 
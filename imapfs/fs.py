@@ -14,19 +14,77 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
+import hashlib
+import os
+import shlex
+import signal
 import stat
-import uuid
+import subprocess
+import threading
+import time
 
 import fuse
 
-from imapfs import directory, file, imapconnection, imapenc, message
+from imapfs import directory, file, filesystem, hints, imapconnection, message, metrics, pipeline, profiler, refs, snapshot, tuning, watcher
 from imapfs.debug_print import debug_print
 
 
-ROOT = str(uuid.UUID(bytes='\0' * 16))
+ROOT = filesystem.ROOT
+PARAMS = filesystem.PARAMS
+
+# Directory of virtual files for inspecting a running mount
+CONTROL_DIR = "/.imapfs"
+
+# Control file that starts and stops the profiler when written to
+PROFILE_FILE = CONTROL_DIR + "/profile"
+
+# Control file that clones a file or snapshots a directory when
+# "SOURCE DEST" is written to it
+CLONE_FILE = CONTROL_DIR + "/clone"
+
+# Control files that can be written to
+WRITABLE_CONTROL_FILES = (PROFILE_FILE, CLONE_FILE)
+
+# When changes are written to the server:
+# sync: before each call that makes them returns, along with the
+#   directories above
+# close: when the file or directory is closed
+# lazy: in the background, once they are older than maxdirty seconds
+# fsync and fsyncdir write a node and the directories above it in every
+# mode. A file's blocks are always written before its manifest, and a node
+# before the directory entry that points to it.
+DURABILITY_MODES = ("sync", "close", "lazy")
+
+# setxattr flags
+XATTR_CREATE = 1
+XATTR_REPLACE = 2
 
 fuse.fuse_python_api = (0, 2)
 
+
+def fuse_op(func):
+  """Decorate a FUSE callback
+  Calls never run alongside the background flusher, and are timed while
+  the profiler runs
+  """
+  name = func.__name__
+
+  def fuse_call(self, *args):
+    with self.lock:
+      if not self.profiler.running:
+        return func(self, *args)
+      start_time = time.time()
+      try:
+        return func(self, *args)
+      finally:
+        self.profiler.add_op(name, time.time() - start_time)
+
+  fuse_call.__name__ = name
+  fuse_call.__doc__ = func.__doc__
+  return fuse_call
+
+
 class IMAPFS(fuse.Fuse):
   """FUSE object for imapfs
   """
@@ -42,33 +100,422 @@ class IMAPFS(fuse.Fuse):
     self.user = ""
     self.password = ""
     self.mailbox = ""
+    self.shards = 1
+    self.backends = ""
+    self.replica = ""
+    self.timeout = imapconnection.DEFAULT_TIMEOUT
+    self.retries = imapconnection.DEFAULT_RETRIES
+    self.workingset = file.File.working_set_size
+    self.workers = 0
+    self.compress = 1
+    self.pool = "threads"
+    self.spool = ""
+    self.tune = 0
+    self.profiledir = "/tmp"
+    self.durability = "close"
+    self.maxdirty = 30
+    self.cachedir = "~/.cache/imapfs"
+    self.keycache = 0
+    self.deferred = 0
+    self.readonly = 0
+    self.poll = 30
+
+    self.snapshot = None
+    self.watcher = None
+    self.profile = None
+    self.profile_time = 0
+    self.profiler = profiler.Profiler(self.profiledir)
+    self.clone_status = ""
+    self.lock = threading.RLock()
+
+    # When each node was first seen dirty by the background flusher
+    self.dirty_times = {}
+
+    metrics.add_gauge("dirty_bytes", self.get_dirty_bytes)
+    metrics.add_gauge("dirty_nodes", lambda: len(self.get_dirty_nodes()))
+    self.ready = threading.Event()
+    self.startup_error = None
 
   def main(self, args=None):
-    # Set up imap
-    """Sets up IMAP connection and encryption
+    """Sets up IMAP connection and encryption, then runs the filesystem
+    With the deferred option, setup runs while FUSE starts up, and
+    filesystem calls wait for it to finish
     """
-    enc = imapenc.IMAPEnc(self.key, int(self.rounds))
-    self.imap = imapconnection.IMAPConnection(self.host, int(self.port), enc)
-    self.imap.login(self.user, self.password)
-    self.imap.select(self.mailbox)
+    self.profiler.directory = os.path.expanduser(self.profiledir)
+    if self.durability not in DURABILITY_MODES:
+      raise Exception("Unknown durability mode %s" % self.durability)
 
-    # Test
-    check = self.check_filesystem()
-    if check is None:
-      self.init_filesystem()
-    elif check == False:
-      raise Exception("Incorrect encryption key")
+    if not int(self.deferred):
+      self.start()
+      if self.startup_error:
+        raise self.startup_error
+
+    if int(self.readonly):
+      self.fuse_args.add("ro")
 
     # Run
     fuse.Fuse.main(self, args)
 
-    # Close all open nodes
-    for node in self.open_nodes.values():
+    if not self.ready.is_set() or self.startup_error:
+      return
+
+    # Keep the background flusher out
+    self.lock.acquire()
+
+    # Close all open nodes. Files go first, as flushing them updates
+    # their directories, and each directory's flush updates its parent.
+    nodes = self.open_nodes.values()
+    directories = [node for node in nodes if node.__class__ == directory.Directory]
+    for node in nodes:
+      if node.__class__ == file.File:
+        self.close_node(node)
+    while [node for node in directories if node.dirty]:
+      for node in directories:
+        self.write_node(node)
+    for node in directories:
       self.close_node(node)
 
+    if file.File.pipeline:
+      file.File.pipeline.close()
+
+    # Save metadata for the next mount
+    if self.snapshot:
+      for node in nodes:
+        self.snapshot.update_node(node.message.name, node.message.data)
+      if file.File.refs:
+        self.snapshot.update_node(refs.REFS, file.File.refs.message.data)
+      self.snapshot.save(self.imap)
+
     # Stop
     self.imap.logout()
 
+  def fsinit(self):
+    """Called by FUSE once the filesystem is mounted
+    Threads are started here rather than in main, as FUSE forks when it
+    goes to the background
+    """
+    signal.signal(signal.SIGUSR2, self.toggle_profiler)
+
+    if self.durability == "lazy":
+      thread = threading.Thread(target=self.run_flusher)
+      thread.daemon = True
+      thread.start()
+
+    if int(self.deferred):
+      thread = threading.Thread(target=self.start)
+      thread.daemon = True
+      thread.start()
+
+  def is_dirty(self, node):
+    """Check if a node has changes that are not on the server yet
+    """
+    if node.dirty:
+      return True
+    if node.__class__ == file.File:
+      for block in node.open_messages.values():
+        if block.dirty:
+          return True
+    return False
+
+  def get_dirty_nodes(self):
+    """Get the open nodes with changes that are not on the server yet
+    """
+    return [node for node in self.open_nodes.values() if self.is_dirty(node)]
+
+  def get_dirty_bytes(self):
+    """Count the bytes of changed blocks and metadata not on the server yet
+    """
+    total = 0
+    for node in self.get_dirty_nodes():
+      if node.__class__ == file.File:
+        for block in node.open_messages.values():
+          if block.dirty:
+            total += len(block.data)
+      if node.dirty:
+        total += len(node.message.data)
+    return total
+
+  def write_node(self, node):
+    """Write a node's changes to the server
+    A file's blocks go first, then its manifest. A directory's changed
+    children go before it, so that no stored entry points to a node that
+    is not stored yet.
+    """
+    if node.__class__ == file.File:
+      node.flush_blocks()
+    else:
+      for child in self.get_dirty_children(node):
+        self.write_node(child)
+    node.flush()
+
+  def get_dirty_children(self, node):
+    """Get the open children of a directory that have changes
+    """
+    return [child for child in self.get_dirty_nodes() if child.parent is node]
+
+  def sync_node(self, node):
+    """Write a node and the directories above it to the server
+    Directories whose entries did not change keep their mtime, so only
+    those with changes are written.
+    """
+    self.write_node(node)
+    while node.parent:
+      node = node.parent
+      self.write_node(node)
+
+  def after_change(self, *nodes):
+    """Write nodes changed by a call, if the durability mode asks for it
+    """
+    if self.durability == "sync":
+      for node in nodes:
+        self.sync_node(node)
+
+  def run_flusher(self):
+    """Write changes older than maxdirty seconds, forever
+    """
+    max_age = float(self.maxdirty)
+    while True:
+      time.sleep(max(max_age / 4, 0.1))
+      if not self.ready.is_set() or self.startup_error:
+        continue
+      with self.lock:
+        try:
+          self.flush_old_nodes(max_age)
+        except Exception, e:
+          debug_print("Background flush failed: %s" % e)
+          metrics.add("flush_errors")
+
+  def flush_old_nodes(self, max_age):
+    """Write the nodes that have had changes for max_age seconds or more
+    Files go first, as writing them changes their directories
+    """
+    now = time.time()
+    dirty = self.get_dirty_nodes()
+    names = set([node.message.name for node in dirty])
+    for name in self.dirty_times.keys():
+      if name not in names:
+        self.dirty_times.pop(name)
+
+    old = []
+    for node in dirty:
+      if now - self.dirty_times.setdefault(node.message.name, now) >= max_age:
+        old.append(node)
+    old.sort(key=lambda node: node.__class__ != file.File)
+
+    for node in old:
+      self.write_node(node)
+      if node.__class__ == file.File:
+        # Drop the written blocks, released files are not told about
+        node.release_blocks()
+      self.dirty_times.pop(node.message.name, None)
+      metrics.add("background_flushes")
+
+  def toggle_profiler(self, signum, frame):
+    """Start the profiler, or stop it if it is running
+    """
+    if self.profiler.running:
+      self.profiler.stop()
+    else:
+      self.profiler.start()
+
+  def control_profiler(self, command):
+    """Handle a command written to the profile control file
+    Takes "stop", or "start" or a number of seconds to profile for
+    """
+    command = command.strip()
+    if command == "stop":
+      self.profiler.stop()
+    elif command == "start":
+      self.profiler.start()
+    elif command.isdigit():
+      self.profiler.start(int(command))
+    else:
+      return False
+    return True
+
+  def clone_node(self, node, copies):
+    """Copy a node, sharing the blocks of files
+    Directories are copied with everything in them. Nothing is written,
+    the copies are added to copies, each after those below it.
+    """
+    if node.__class__ == file.File:
+      # The copy lists the stored blocks
+      self.write_node(node)
+      copy = node.clone()
+    else:
+      copy = directory.Directory.create(self.imap, node.hints)
+      for child_key, child_name in node.children.items():
+        # Nodes opened only to be copied are closed again
+        was_open = child_key in self.open_nodes
+        child = self.open_node(child_key)
+        if not child:
+          continue
+        child_copy = self.clone_node(child, copies)
+        child_copy.parent = copy
+        copy.add_child(child_copy.message.name, child_name, child_copy.get_attrs())
+        if not was_open:
+          self.close_node(child)
+    copies.append(copy)
+    return copy
+
+  def control_clone(self, command):
+    """Handle a command written to the clone control file
+    Takes the paths of an existing node and of its copy, which may be
+    quoted. Returns 0 or a negative errno.
+    """
+    try:
+      paths = shlex.split(command)
+    except ValueError:
+      return -fuse.EINVAL
+    if len(paths) != 2:
+      return -fuse.EINVAL
+    source_path, dest_path = ["/" + path.strip("/") for path in paths]
+
+    # A directory cannot be copied into itself
+    if dest_path == source_path or dest_path.startswith(source_path.rstrip("/") + "/"):
+      return -fuse.EINVAL
+
+    source = self.get_node_by_path(source_path)
+    parent = self.get_node_by_path(self.get_path_parent(dest_path))
+    if not source or not parent:
+      return -fuse.ENOENT
+    if parent.__class__ != directory.Directory:
+      return -fuse.ENOTDIR
+    if parent.get_child_by_name(self.get_path_filename(dest_path)):
+      return -fuse.EEXIST
+
+    debug_print("Cloning %s to %s" % (source_path, dest_path))
+
+    # References are stored before the manifests that add them, and the
+    # copy is in its directory once this returns
+    copies = []
+    copy = self.clone_node(source, copies)
+    file.File.refs.flush()
+    for node in copies:
+      node.flush()
+    parent.add_child(copy.message.name, self.get_path_filename(dest_path), copy.get_attrs())
+    self.sync_node(parent)
+
+    metrics.add("clones")
+    self.clone_status = "cloned %s to %s, %d nodes\n" % (source_path, dest_path, len(copies))
+    return 0
+
+  def start(self):
+    """Connects, sets up encryption and checks the filesystem
+    Logs how long each step took
+    """
+    start_time = time.time()
+    self.startup_times = []
+    file.File.working_set_size = int(self.workingset)
+    file.File.codec = file.CODEC_BZ2 if int(self.compress) else file.CODEC_NONE
+    if int(self.workers) > 0:
+      file.File.pipeline = pipeline.Pipeline(int(self.workers), self.pool == "processes")
+    try:
+      if self.spool:
+        file.File.spool_dir = os.path.expanduser(self.spool)
+        if not os.path.isdir(file.File.spool_dir):
+          os.makedirs(file.File.spool_dir, 0700)
+
+      phase_time = time.time()
+      self.imap = filesystem.create_connection(self)
+      phase_time = self.time_phase("connect", phase_time)
+      self.imap.login(self.user, self.password)
+      phase_time = self.time_phase("login", phase_time)
+      self.imap.select(self.mailbox)
+      phase_time = self.time_phase("select", phase_time)
+
+      enc = filesystem.setup_encryption(self.imap, self.key, int(self.rounds), int(self.keycache),
+                                        filesystem.get_account(self))
+      self.imap.set_encryption(enc)
+      phase_time = self.time_phase("key", phase_time)
+
+      # Start watching before anything is cached, so no change is missed
+      if int(self.readonly):
+        watch_conn = filesystem.create_connection(self)
+        watch_conn.login(self.user, self.password)
+        watch_conn.select(self.mailbox)
+        self.watcher = watcher.Watcher(watch_conn, float(self.poll))
+        phase_time = self.time_phase("watch", phase_time)
+
+      # Load metadata saved by the last mount, if the mailbox is unchanged.
+      # Loading consumes the snapshot, so read-only mounts leave it for
+      # the writer.
+      if self.cachedir and not int(self.readonly):
+        self.snapshot = snapshot.Snapshot(self.get_snapshot_path(), enc)
+        self.snapshot.load(self.imap)
+        phase_time = self.time_phase("snapshot", phase_time)
+
+      # Test
+      check = self.check_filesystem()
+      if check is None:
+        if int(self.readonly):
+          raise Exception("No filesystem found")
+        self.init_filesystem()
+      elif check == False:
+        raise Exception("Incorrect encryption key")
+      if not int(self.readonly):
+        data = self.snapshot.get_node(refs.REFS) if self.snapshot else None
+        file.File.refs = refs.RefTable.load(self.imap, data)
+      phase_time = self.time_phase("check", phase_time)
+
+      # Read-only mounts write nothing, so there is nothing to tune
+      if int(self.tune) and not int(self.readonly):
+        self.profile = tuning.probe(self.imap, enc)
+        self.profile_time = time.time()
+        self.apply_profile()
+        debug_print("Transfer profile: %s" % self.profile.format())
+        phase_time = self.time_phase("tune", phase_time)
+    except Exception, e:
+      self.startup_error = e
+      if int(self.deferred):
+        debug_print("Startup failed: %s" % e)
+        subprocess.call(["fusermount", "-u", "-z", self.fuse_args.mountpoint])
+    finally:
+      self.ready.set()
+
+    debug_print("Startup took %.3fs: %s" % (time.time() - start_time, ", ".join(self.startup_times)))
+
+  def time_phase(self, name, phase_time):
+    """Record the time taken by a startup step
+    Returns the current time
+    """
+    now = time.time()
+    self.startup_times.append("%s %.3fs" % (name, now - phase_time))
+    return now
+
+  def apply_profile(self):
+    """Use the block size, compression and workers chosen by the profile
+    """
+    file.File.new_block_size = self.profile.block_size
+    file.File.codec = file.CODEC_BZ2 if self.profile.compress else file.CODEC_NONE
+
+    current = file.File.pipeline.workers if file.File.pipeline else 0
+    if self.profile.workers != current:
+      if file.File.pipeline:
+        file.File.pipeline.close()
+      file.File.pipeline = None
+      if self.profile.workers > 0:
+        file.File.pipeline = pipeline.Pipeline(self.profile.workers, self.pool == "processes")
+
+  def adapt_profile(self):
+    """Update the profile from the transfers made since the last update
+    """
+    if not self.profile or time.time() - self.profile_time < tuning.ADAPT_INTERVAL:
+      return
+    self.profile_time = time.time()
+
+    if self.profile.update():
+      self.apply_profile()
+      debug_print("Transfer profile changed: %s" % self.profile.format())
+
+  def wait_ready(self):
+    """Wait for startup to finish
+    Raises IOError if it failed
+    """
+    self.ready.wait()
+    if self.startup_error:
+      raise IOError(errno.EIO, "Startup failed")
+
   def open_node(self, name):
     """Opens a node (file or directory)
     """
@@ -77,22 +524,20 @@ class IMAPFS(fuse.Fuse):
     if name in self.open_nodes:
       return self.open_nodes[name]
 
-    try:
-      msg = message.Message.open(self.imap, name)
-      if not msg:
+    # Use the snapshot copy if there is one
+    data = self.snapshot.get_node(name) if self.snapshot else None
+    if data is not None:
+      msg = message.Message(self.imap, name, data)
+    else:
+      try:
+        msg = message.Message.open(self.imap, name)
+        if not msg:
+          return None
+      except IOError:
         return None
-    except:
-      return None
 
     # Determine file or dir
-    type_code = chr(msg.data[0])
-
-    if type_code == 'f':
-      obj = file.File.from_message(msg)
-    elif type_code == 'd':
-      obj = directory.Directory.from_message(msg)
-    else:
-      raise Exception("Bad node")
+    obj = filesystem.node_from_message(msg)
 
     self.open_nodes[name] = obj
     return obj
@@ -104,6 +549,56 @@ class IMAPFS(fuse.Fuse):
     if node.message.name in self.open_nodes:
       self.open_nodes.pop(node.message.name)
 
+  def forget_node(self, node):
+    """Drop a deleted node from the caches
+    """
+    if node.message.name in self.open_nodes:
+      self.open_nodes.pop(node.message.name)
+    if self.snapshot:
+      self.snapshot.forget_node(node.message.name)
+
+  def apply_changes(self):
+    """Drop cached nodes and UIDs that another client changed
+    Only read-only mounts watch for changes
+    """
+    if not self.watcher:
+      return
+
+    changes = self.watcher.get_changes()
+    if not changes:
+      return
+
+    # Files may still be referenced after they are dropped, so their open
+    # blocks go too. Blocks are rewritten under the same name, which does
+    # not change the manifest.
+    changed = set(changes)
+    for node in self.open_nodes.values():
+      if node.__class__ != file.File:
+        continue
+      for block_id, block in node.open_messages.items():
+        if None in changed or node.message.name in changed or block.name in changed:
+          node.open_messages.pop(block_id)
+
+    for name in changes:
+      metrics.add("invalidations")
+      if name is None:
+        debug_print("Mailbox changed, dropping all cached nodes")
+        self.open_nodes.clear()
+        self.imap.clear_cache()
+        continue
+
+      debug_print("%s changed" % name)
+      self.imap.forget_subject(name)
+      if name in self.open_nodes:
+        self.open_nodes.pop(name)
+
+  def get_snapshot_path(self):
+    """Gets the path of the local metadata snapshot
+    One snapshot is kept per server, user and mailbox
+    """
+    ident = "%s\t%s\t%s\t%s" % (self.host, self.port, self.user, self.mailbox)
+    return os.path.join(os.path.expanduser(self.cachedir), hashlib.sha1(ident).hexdigest())
+
   def check_filesystem(self):
     """Check if there is a filesystem present
     Returns True, False or None
@@ -132,6 +627,8 @@ class IMAPFS(fuse.Fuse):
   def init_filesystem(self):
     """Create a filesystem
     """
+    self.imap.put_message(PARAMS, self.imap.enc.format_params(), encrypted=False)
+
     root = directory.Directory.create(self.imap)
     root.message.name = ROOT
     root.close()
@@ -140,6 +637,10 @@ class IMAPFS(fuse.Fuse):
     """Open the node specified by path
     Walks through the directory tree to find the node
     """
+    self.wait_ready()
+    self.apply_changes()
+    self.adapt_profile()
+
     # handle root
     if path == "/":
       return self.open_node(ROOT)
@@ -164,9 +665,54 @@ class IMAPFS(fuse.Fuse):
       child_node = self.open_node(child_key)
       if not child_node:
         return None
+      child_node.parent = current_node
       current_node = child_node
     return current_node
 
+  def get_control_file(self, path):
+    """Get the contents of a virtual file in the control directory
+    Returns None if path is not one
+    """
+    if path == CONTROL_DIR + "/stats":
+      return metrics.format_metrics()
+    if path == PROFILE_FILE:
+      return self.profiler.format_status()
+    if path == CLONE_FILE:
+      return self.clone_status
+    if path == CONTROL_DIR + "/tuning":
+      if not self.profile:
+        return "off\n"
+      return self.profile.format() + "\n"
+    return None
+
+  def get_attrs_by_path(self, path):
+    """Get the type, size, ctime and mtime of the node at path
+    Nodes that are not open are not fetched, their entry in the parent
+    directory is used instead. Returns None if not found.
+    """
+    if path != "/":
+      parent = self.get_node_by_path(self.get_path_parent(path))
+      if parent.__class__ == directory.Directory:
+        child_key = parent.get_child_by_name(self.get_path_filename(path))
+        if not child_key:
+          return None
+        if child_key not in self.open_nodes and child_key in parent.attrs:
+          return parent.attrs[child_key]
+
+    node = self.get_node_by_path(path)
+    if not node:
+      return None
+    return node.get_attrs()
+
+  def get_node_hints(self, node):
+    """Get the hints of a node
+    Files always have a block size
+    """
+    node_hints = dict(node.hints)
+    if node.__class__ == file.File:
+      node_hints["blocksize"] = str(node.block_size)
+    return node_hints
+
   def get_path_parent(self, path):
     """Gets the parent part of a path
     """
@@ -183,6 +729,7 @@ class IMAPFS(fuse.Fuse):
   # Filesystem functions
   #
 
+  @fuse_op
   def statfs(self):
     st = fuse.StatVfs()
     st.f_bsize = file.FS_BLOCK_SIZE
@@ -190,39 +737,70 @@ class IMAPFS(fuse.Fuse):
 
     return st
 
+  @fuse_op
   def getattr(self, path):
-    node = self.get_node_by_path(path)
+    st = fuse.Stat()
 
-    if not node:
-      return -fuse.ENOENT
+    if path == CONTROL_DIR:
+      st.st_mode = stat.S_IFDIR | 0555
+      st.st_nlink = 2
+      st.st_size = 4096
+      return st
 
-    st = fuse.Stat()
+    control_data = self.get_control_file(path)
+    if control_data is not None:
+      st.st_mode = stat.S_IFREG | (0644 if path in WRITABLE_CONTROL_FILES else 0444)
+      st.st_nlink = 1
+      st.st_size = len(control_data)
+      return st
 
-    if node.__class__ == directory.Directory:
+    attrs = self.get_attrs_by_path(path)
+
+    if not attrs:
+      return -fuse.ENOENT
+
+    node_type, size, ctime, mtime = attrs
+    if node_type == "d":
       st.st_mode = stat.S_IFDIR | 0777
       st.st_nlink = 2
       st.st_size = 4096
     else:
       st.st_mode = stat.S_IFREG | 0666
       st.st_nlink = 1
-      st.st_size = node.size
+      st.st_size = size
+    st.st_ctime = ctime
+    st.st_mtime = mtime
+    st.st_atime = mtime
 
     return st
 
   def readdir(self, path, offset):
-    node = self.get_node_by_path(path)
-    if node.__class__ != directory.Directory:
+    if path == CONTROL_DIR:
+      for name in (".", "..", "stats", "tuning", "profile", "clone"):
+        yield fuse.Direntry(name)
       return
 
+    # A generator cannot use fuse_op, and must not hold the lock between
+    # entries
+    with self.lock:
+      node = self.get_node_by_path(path)
+      if node.__class__ != directory.Directory:
+        return
+      names = node.children.values()
+
     debug_print("Listing %s/" % path)
 
     yield fuse.Direntry(".")
     yield fuse.Direntry("..")
 
-    for child_name in node.children.values():
+    for child_name in names:
       yield fuse.Direntry(child_name)
 
+  @fuse_op
   def mkdir(self, path, mode):
+    if int(self.readonly):
+      return -fuse.EROFS
+
     parent = self.get_node_by_path(self.get_path_parent(path))
     if not parent:
       return -fuse.ENOENT
@@ -232,11 +810,17 @@ class IMAPFS(fuse.Fuse):
 
     debug_print("Creating directory %s/" % path)
 
-    child = directory.Directory.create(self.imap)
+    child = directory.Directory.create(self.imap, parent.hints)
+    child.parent = parent
     self.open_nodes[child.message.name] = child
-    parent.add_child(child.message.name, self.get_path_filename(path))
+    parent.add_child(child.message.name, self.get_path_filename(path), child.get_attrs())
+    self.after_change(child)
 
+  @fuse_op
   def rmdir(self, path):
+    if int(self.readonly):
+      return -fuse.EROFS
+
     child = self.get_node_by_path(path)
     if not child:
       return -fuse.ENOENT
@@ -254,10 +838,16 @@ class IMAPFS(fuse.Fuse):
     debug_print("Removing directory %s/" % path)
 
     parent.remove_child(child.message.name)
+    self.after_change(parent)
     self.close_node(child)
+    self.forget_node(child)
     message.Message.unlink(self.imap, child.message.name)
 
+  @fuse_op
   def mknod(self, path, mode, dev):
+    if int(self.readonly):
+      return -fuse.EROFS
+
     parent = self.get_node_by_path(self.get_path_parent(path))
     if not parent:
       return -fuse.ENOENT
@@ -267,11 +857,17 @@ class IMAPFS(fuse.Fuse):
 
     debug_print("Creating file %s" % path)
 
-    node = file.File.create(self.imap)
+    node = file.File.create(self.imap, parent.hints)
+    node.parent = parent
     self.open_nodes[node.message.name] = node
-    parent.add_child(node.message.name, self.get_path_filename(path))
+    parent.add_child(node.message.name, self.get_path_filename(path), node.get_attrs())
+    self.after_change(node)
 
+  @fuse_op
   def rename(self, oldpath, newpath):
+    if int(self.readonly):
+      return -fuse.EROFS
+
     # handle dir name
     if not self.get_path_filename(newpath):
       newpath += self.get_path_filename(oldpath)
@@ -292,6 +888,7 @@ class IMAPFS(fuse.Fuse):
       child_key = parent.get_child_by_name(self.get_path_filename(oldpath))
       parent.children[child_key] = self.get_path_filename(newpath)
       parent.dirty = True
+      self.after_change(parent)
     else:
       # Different parent
       old_node = self.get_node_by_path(oldpath)
@@ -309,18 +906,30 @@ class IMAPFS(fuse.Fuse):
       new_parent = self.get_node_by_path(self.get_path_parent(newpath))
 
       # Remove old, add new
-      new_parent.add_child(old_node.message.name, self.get_path_filename(oldpath))
+      new_parent.add_child(old_node.message.name, self.get_path_filename(newpath), old_node.get_attrs())
       old_parent.remove_child(old_node.message.name)
+      old_node.parent = new_parent
+      # The new entry is written first, so a crash cannot lose the node
+      self.after_change(new_parent, old_parent)
 
+  @fuse_op
   def utime(self, path, times):
+    if int(self.readonly):
+      return -fuse.EROFS
+
     node = self.get_node_by_path(path)
     if not node:
       return -fuse.ENOENT
 
     node.mtime = times[1]
     node.dirty = True
+    self.after_change(node)
 
+  @fuse_op
   def unlink(self, path):
+    if int(self.readonly):
+      return -fuse.EROFS
+
     node = self.get_node_by_path(path)
     if not node or node.__class__ != file.File:
       return -fuse.ENOENT
@@ -332,10 +941,18 @@ class IMAPFS(fuse.Fuse):
     debug_print("Removing %s" % path)
 
     parent.remove_child(node.message.name)
+    self.after_change(parent)
     node.delete()
-    self.open_nodes.pop(node.message.name)
+    self.forget_node(node)
 
+  @fuse_op
   def truncate(self, path, size):
+    if path in WRITABLE_CONTROL_FILES:
+      return 0
+
+    if int(self.readonly):
+      return -fuse.EROFS
+
     node = self.get_node_by_path(path)
     if not node:
       return -fuse.ENOENT
@@ -346,8 +963,14 @@ class IMAPFS(fuse.Fuse):
     debug_print("Resizing %s to %d" % (path, size))
 
     node.truncate(size)
+    self.after_change(node)
 
+  @fuse_op
   def read(self, path, size, offset):
+    control_data = self.get_control_file(path)
+    if control_data is not None:
+      return control_data[offset:offset + size]
+
     node = self.get_node_by_path(path)
     if not node:
       return -fuse.ENOENT
@@ -361,22 +984,37 @@ class IMAPFS(fuse.Fuse):
 
     return data
 
+  @fuse_op
   def write(self, path, buf, offset):
+    if path == PROFILE_FILE:
+      if not self.control_profiler(str(buf)):
+        return -fuse.EINVAL
+      return len(buf)
+
+    if int(self.readonly):
+      return -fuse.EROFS
+
+    if path == CLONE_FILE:
+      result = self.control_clone(str(buf))
+      if result < 0:
+        return result
+      return len(buf)
+
     node = self.get_node_by_path(path)
     if not node:
       return -fuse.ENOENT
     if node.__class__ != file.File:
       return -fuse.EISDIR
 
-    byte_buf = bytearray(buf)
-
     node.seek(offset)
-    node.write(byte_buf)
+    node.write(memoryview(buf))
+    self.after_change(node)
 
     debug_print("Write %d-%d" % (offset, offset + len(buf)))
 
     return len(buf)
 
+  @fuse_op
   def release(self, path, flags):
     node = self.get_node_by_path(path)
     if not node:
@@ -384,10 +1022,40 @@ class IMAPFS(fuse.Fuse):
 
     debug_print("Closing %s" % path)
 
-    node.close_blocks()
+    # Lazy mode leaves changed blocks for the background flusher
+    if self.durability == "lazy":
+      if not self.is_dirty(node):
+        node.release_blocks()
+      return
 
-    node.flush()
+    # The file's entry in its directory holds its size and mtime
+    node.release_blocks()
+    self.sync_node(node)
+
+  @fuse_op
+  def flush(self, path):
+    if path.startswith(CONTROL_DIR):
+      return 0
 
+    node = self.get_node_by_path(path)
+    if not node:
+      return -fuse.ENOENT
+
+    # Errors here are returned by close(), unlike those of release
+    if self.durability != "lazy":
+      self.sync_node(node)
+
+  @fuse_op
+  def fsync(self, path, isfsyncfile):
+    node = self.get_node_by_path(path)
+    if not node:
+      return -fuse.ENOENT
+
+    debug_print("Syncing %s" % path)
+
+    self.sync_node(node)
+
+  @fuse_op
   def releasedir(self, path):
     node = self.get_node_by_path(path)
     if not node:
@@ -395,10 +1063,117 @@ class IMAPFS(fuse.Fuse):
 
     debug_print("Closing %s/" % path)
 
-    node.flush()
+    if self.durability != "lazy":
+      self.sync_node(node)
+
+  @fuse_op
+  def fsyncdir(self, path, isfsyncfile):
+    node = self.get_node_by_path(path)
+    if not node:
+      return -fuse.ENOENT
+
+    debug_print("Syncing %s/" % path)
 
+    self.sync_node(node)
+
+  @fuse_op
   def chmod(self, path, mode):
+    if int(self.readonly):
+      return -fuse.EROFS
     return 0
 
+  @fuse_op
   def chown(self, path, user, group):
+    if int(self.readonly):
+      return -fuse.EROFS
     return 0
+
+  @fuse_op
+  def getxattr(self, path, name, size):
+    if path.startswith(CONTROL_DIR):
+      return -fuse.ENODATA
+
+    node = self.get_node_by_path(path)
+    if not node:
+      return -fuse.ENOENT
+
+    value = self.get_node_hints(node).get(hints.get_name(name))
+    if value is None:
+      return -fuse.ENODATA
+
+    # A size of 0 asks how much room the value needs
+    if size == 0:
+      return len(value)
+    return value
+
+  @fuse_op
+  def listxattr(self, path, size):
+    names = []
+    if not path.startswith(CONTROL_DIR):
+      node = self.get_node_by_path(path)
+      if not node:
+        return -fuse.ENOENT
+      names = [hints.XATTR_PREFIX + name for name in sorted(self.get_node_hints(node).keys())]
+
+    # A size of 0 asks how much room the NUL separated list needs
+    if size == 0:
+      return len("".join(names)) + len(names)
+    return names
+
+  @fuse_op
+  def setxattr(self, path, name, value, flags):
+    hint = hints.get_name(name)
+    if hint is None or path.startswith(CONTROL_DIR):
+      return -fuse.EOPNOTSUPP
+
+    if int(self.readonly):
+      return -fuse.EROFS
+
+    node = self.get_node_by_path(path)
+    if not node:
+      return -fuse.ENOENT
+
+    node_hints = self.get_node_hints(node)
+    if flags & XATTR_CREATE and hint in node_hints:
+      return -fuse.EEXIST
+    if flags & XATTR_REPLACE and hint not in node_hints:
+      return -fuse.ENODATA
+
+    value = hints.check(hint, str(value))
+    if value is None:
+      return -fuse.EINVAL
+
+    debug_print("Setting %s of %s to %s" % (hint, path, value))
+
+    if hint == "blocksize" and node.__class__ == file.File:
+      if not node.set_block_size(int(value)):
+        return -fuse.EBUSY
+    elif node.hints.get(hint) != value:
+      node.hints[hint] = value
+      node.dirty = True
+    self.after_change(node)
+
+  @fuse_op
+  def removexattr(self, path, name):
+    hint = hints.get_name(name)
+    if hint is None or path.startswith(CONTROL_DIR):
+      return -fuse.ENODATA
+
+    if int(self.readonly):
+      return -fuse.EROFS
+
+    node = self.get_node_by_path(path)
+    if not node:
+      return -fuse.ENOENT
+
+    # Every file has a block size
+    if hint == "blocksize" and node.__class__ == file.File:
+      return -fuse.EPERM
+    if hint not in node.hints:
+      return -fuse.ENODATA
+
+    debug_print("Clearing %s of %s" % (hint, path))
+
+    node.hints.pop(hint)
+    node.dirty = True
+    self.after_change(node)
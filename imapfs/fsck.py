@@ -0,0 +1,242 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Offline filesystem check and garbage collection.
+#
+# Marks every message reachable from the root, then deletes node and block
+# messages that are unreachable, and old copies of messages left behind by
+# interrupted updates. The reference counts of blocks shared by clones are
+# recomputed. With a replica, its mailbox is checked the same way. The
+# filesystem must not be mounted while this runs.
+#
+# Usage: python -m imapfs.fsck [options]
+
+import optparse
+import sys
+import time
+
+from imapfs import debug_print, directory, file, filesystem, imapconnection, message, refs
+
+
+class Checker:
+  """Finds garbage messages in a filesystem
+  """
+
+  def __init__(self, conn):
+    self.conn = conn
+    self.messages = {}
+    self.deleted = []
+    self.reachable = set()
+    self.missing = []
+    self.unread = []
+    self.ref_counts = {}
+
+  def list_messages(self):
+    """Get all messages, grouped by subject
+    Node and block messages that are already deleted are kept separately
+    """
+    self.messages = {}
+    self.deleted = []
+    for uid, subject, size, deleted in self.conn.list_messages():
+      if deleted:
+        if filesystem.NAME_PATTERN.match(subject):
+          self.deleted.append((uid, size))
+      else:
+        self.messages.setdefault(subject, []).append((uid, size))
+
+    # Copies of a subject are always on the same connection, so the last
+    # part of a combined "index:uid" UID orders them
+    for copies in self.messages.values():
+      copies.sort(key=lambda copy: int(copy[0].rpartition(":")[2]))
+
+  def mark(self):
+    """Mark all messages reachable from the root
+    The tree is walked one level at a time, fetching the nodes of each
+    level in batches
+    """
+    self.reachable = set([filesystem.PARAMS, refs.REFS])
+    self.missing = []
+    self.unread = []
+    self.ref_counts = {}
+    pending = [filesystem.ROOT]
+    while pending:
+      names = []
+      for name in pending:
+        if name in self.reachable:
+          continue
+        self.reachable.add(name)
+
+        if name not in self.messages:
+          self.missing.append(name)
+          self.unread.append(name)
+          continue
+        names.append(name)
+
+      pending = []
+      for i in range(0, len(names), imapconnection.BATCH_SIZE):
+        pending.extend(self.mark_nodes(names[i:i + imapconnection.BATCH_SIZE]))
+
+  def mark_nodes(self, names):
+    """Fetch and mark a batch of nodes
+    Returns the names of the nodes in the directories among them. Nodes
+    that cannot be read are added to unread, as they may be directories
+    whose children are not marked.
+    """
+    # Use the newest copy, like get_uid_by_subject does
+    uids = dict([(name, self.messages[name][-1][0]) for name in names])
+    fetched = self.conn.get_messages(uids.values())
+
+    children = []
+    for name in names:
+      if uids[name] not in fetched:
+        self.missing.append(name)
+        self.unread.append(name)
+        continue
+
+      try:
+        node = filesystem.node_from_message(message.Message(self.conn, name, fetched.pop(uids[name])))
+      except Exception, e:
+        print "Cannot read node %s: %s" % (name, e)
+        self.unread.append(name)
+        continue
+      if node.__class__ == directory.Directory:
+        children.extend(node.children.keys())
+      elif node.__class__ == file.File:
+        for block_key in node.blocks.values():
+          self.ref_counts[block_key] = self.ref_counts.get(block_key, 0) + 1
+          self.reachable.add(block_key)
+          if block_key not in self.messages:
+            self.missing.append(block_key)
+    return children
+
+  def get_missing_roots(self):
+    """Get the messages every filesystem has that are not in the mailbox
+    If any are missing, this is the wrong mailbox or the connection
+    options do not match the filesystem, and everything would look like
+    garbage
+    """
+    return [name for name in (filesystem.ROOT, filesystem.PARAMS) if name not in self.messages]
+
+  def check_refs(self):
+    """Compare the stored reference counts with those found by mark
+    Returns the table, set to the found counts, and the number of blocks
+    whose count was wrong
+    """
+    table = refs.RefTable.load(self.conn)
+    counts = dict([(block_key, count) for block_key, count in self.ref_counts.items() if count > 1])
+    wrong = len([block_key for block_key in set(counts.keys() + table.counts.keys())
+                 if counts.get(block_key) != table.counts.get(block_key)])
+    if wrong:
+      table.counts = counts
+      table.dirty = True
+    return table, wrong
+
+  def get_garbage(self):
+    """Get the messages to remove
+    Returns lists of unreachable and duplicate (uid, size) pairs
+    Only messages named like nodes and blocks are considered, so other mail
+    in the mailbox is left alone
+    """
+    unreachable = []
+    duplicates = []
+    for subject, copies in self.messages.items():
+      if not filesystem.NAME_PATTERN.match(subject):
+        continue
+      if subject not in self.reachable:
+        unreachable.extend(copies)
+      else:
+        duplicates.extend(copies[:-1])
+    return unreachable, duplicates
+
+
+def format_size(size):
+  return "%.1f MiB" % (float(size) / 1048576)
+
+
+def check_mailbox(conn, dry_run):
+  """Check the filesystem in one mailbox and remove its garbage
+  Returns False if there is no filesystem in it
+  """
+  checker = Checker(conn)
+
+  phase_time = time.time()
+  checker.list_messages()
+  print "Listed %d messages in %.2fs" % (sum([len(copies) for copies in checker.messages.values()]), time.time() - phase_time)
+
+  missing_roots = checker.get_missing_roots()
+  if missing_roots:
+    print "No filesystem found, %s missing" % " and ".join(missing_roots)
+    return False
+
+  phase_time = time.time()
+  checker.mark()
+  print "Marked %d reachable messages in %.2fs" % (len(checker.reachable), time.time() - phase_time)
+  for name in checker.missing:
+    print "Missing message %s" % name
+
+  table, wrong = checker.check_refs()
+  print "Shared blocks: %d, %d with a wrong reference count" % (len(table.counts), wrong)
+
+  unreachable, duplicates = checker.get_garbage()
+  garbage = unreachable + duplicates
+  print "Unreachable: %d messages, %s" % (len(unreachable), format_size(sum([size for uid, size in unreachable])))
+  print "Duplicates: %d messages, %s" % (len(duplicates), format_size(sum([size for uid, size in duplicates])))
+  print "Already deleted: %d messages, %s" % (len(checker.deleted), format_size(sum([size for uid, size in checker.deleted])))
+
+  if checker.unread and not dry_run:
+    print "Not removing anything, %d nodes could not be read" % len(checker.unread)
+  elif not dry_run:
+    table.flush()
+
+    phase_time = time.time()
+    conn.delete_messages([uid for uid, size in garbage])
+    conn.expunge([uid for uid, size in garbage + checker.deleted])
+    print "Removed %d messages, reclaimed %s in %.2fs" % (
+        len(garbage) + len(checker.deleted),
+        format_size(sum([size for uid, size in garbage + checker.deleted])),
+        time.time() - phase_time)
+  return True
+
+
+def main():
+  parser = optparse.OptionParser(usage="python -m imapfs.fsck [options]")
+  filesystem.add_connection_options(parser)
+  parser.add_option("-n", "--dry-run", action="store_true", help="Only report, do not delete anything")
+  parser.add_option("-v", "--verbose", action="store_true", help="Print debug output")
+  options, args = parser.parse_args()
+
+  debug_print.enabled = options.verbose
+
+  start_time = time.time()
+  conn = filesystem.connect(options)
+
+  if not check_mailbox(conn, options.dry_run):
+    conn.logout()
+    sys.exit("Check the mailbox and the shards, backends and replica options.")
+
+  # The replica is a filesystem of its own, with its own garbage. Its
+  # reference counts are checked after the primary's are written to both.
+  if options.replica:
+    print "Checking the replica"
+    if not check_mailbox(conn.conns[1], options.dry_run):
+      print "Not checking the replica further"
+
+  conn.logout()
+  print "Done in %.2fs" % (time.time() - start_time)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,87 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Per-node hints on how to store and cache a file, set through extended
+# attributes named user.imapfs.<hint>.
+#
+# Hints are kept as name=value fields after the other fields of the header
+# line of a file manifest or directory, which older versions ignore. Hints
+# set on a directory are given to the files and directories created in it.
+
+XATTR_PREFIX = "user.imapfs."
+
+# blocksize: bytes per block of new files. A file's own block size can
+# only change while it has no blocks.
+# codec: bz2 or none, for the blocks written from then on
+# prefetch: number of blocks to fetch past the end of each read
+# pin: 1 to keep the blocks of an open file in memory until unmount
+NAMES = ("blocksize", "codec", "prefetch", "pin")
+
+CODECS = ("bz2", "none")
+
+# Block sizes are multiples of MIN_BLOCK_SIZE up to MAX_BLOCK_SIZE
+MIN_BLOCK_SIZE = 4096
+MAX_BLOCK_SIZE = 16777216
+
+
+def get_name(xattr_name):
+  """Get the hint an extended attribute name refers to
+  Returns None if it is not one
+  """
+  if not xattr_name.startswith(XATTR_PREFIX):
+    return None
+  name = xattr_name[len(XATTR_PREFIX):]
+  if name not in NAMES:
+    return None
+  return name
+
+
+def check(name, value):
+  """Check the value of a hint
+  Returns it in the form it is stored in, or None if it is not valid
+  """
+  value = value.strip()
+  if name == "codec":
+    return value if value in CODECS else None
+
+  if not value.isdigit():
+    return None
+  number = int(value)
+  if name == "blocksize":
+    if number < MIN_BLOCK_SIZE or number > MAX_BLOCK_SIZE or number % MIN_BLOCK_SIZE:
+      return None
+  elif name == "pin":
+    if number > 1:
+      return None
+  return str(number)
+
+
+def parse(fields):
+  """Get the hints from the name=value fields of a header line
+  Fields that are not hints are skipped
+  """
+  hints = {}
+  for field in fields:
+    name, sep, value = field.partition("=")
+    if sep and name in NAMES:
+      hints[name] = value
+  return hints
+
+
+def format(hints):
+  """Format hints as fields to add to a header line
+  """
+  return "".join(["\t%s=%s" % (name, hints[name]) for name in sorted(hints.keys())])
@@ -17,49 +17,248 @@
 import email.mime.text
 import imaplib
 import re
+import socket
 import time
+import uuid
+
+from imapfs import imapenc, metrics
+from imapfs.debug_print import debug_print
+
+
+# Number of messages per bulk FETCH or STORE command
+BATCH_SIZE = 500
+
+# Seconds a command may wait for the server before the connection is
+# considered dead, and how often failed commands are tried again
+DEFAULT_TIMEOUT = 60
+DEFAULT_RETRIES = 3
+
+# Bytes per base64 line of a stored message, which has CRLF line ends
+STORED_LINE = imapenc.BASE64_LINE + 2
+
+# Errors that leave a connection unusable. SSL errors and timeouts are
+# socket errors, and imaplib raises abort on BYE and broken responses.
+CONNECTION_ERRORS = (socket.error, imaplib.IMAP4.abort)
+
+
+def format_uid_set(uids):
+  """Format a list of UIDs as an IMAP sequence set
+  """
+  return ",".join([str(uid) for uid in uids])
+
+
+def parse_subject(literals):
+  """Get the subject from the header literals of a FETCH response
+  """
+  match = re.search("^Subject: *(.*?)\r?$", "".join(literals), re.I | re.M)
+  return match.group(1) if match else ""
+
+
+def parse_fetch(data):
+  """Split a FETCH response into one entry per message
+  Returns a list of (text, literals) pairs. text holds everything except
+  the literals, like UID and FLAGS items.
+  """
+  messages = []
+  for item in data:
+    if item is None:
+      continue
+    if isinstance(item, tuple):
+      text, literals = item[0], [item[1]]
+    else:
+      text, literals = item, []
+
+    if re.match("[0-9]+ \\(", text) or not messages:
+      messages.append((text, literals))
+    else:
+      messages[-1] = (messages[-1][0] + text, messages[-1][1] + literals)
+  return messages
 
 
 class IMAPConnection:
   """Class that manages a connection to an IMAP server
   """
 
-  def __init__(self, host, port, enc):
+  def __init__(self, host, port, enc, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
     """Connects to host:port
+    Commands that get no answer for timeout seconds fail, and idempotent
+    commands are tried again on a new connection up to retries times
     """
-    self.conn = imaplib.IMAP4_SSL(host, port)
+    self.host = host
+    self.port = port
     self.enc = enc
+    self.timeout = timeout
+    self.retries = retries
+    self.user = None
+    self.passwd = None
     self.mailbox = "INBOX"
+    self.selected = False
+    self.uidvalidity = None
     self.uid_cache = {}
+    self.capabilities = ()
+
+    self.conn = None
+    self.open()
+
+  def open(self):
+    """Open the connection to the server
+    """
+    self.conn = imaplib.IMAP4_SSL(self.host, self.port)
+    self.conn.sock.settimeout(self.timeout)
+    self.capabilities = self.conn.capabilities
+
+  def drop(self):
+    """Throw away a broken connection
+    The next command opens a new one
+    """
+    if self.conn is None:
+      return
+    try:
+      self.conn.shutdown()
+    except Exception:
+      pass
+    self.conn = None
+
+  def reconnect(self):
+    """Open a new connection, log in and select the mailbox again
+    Cached UIDs are kept unless the mailbox's UIDVALIDITY changed
+    """
+    debug_print("Reconnecting to %s:%d" % (self.host, self.port))
+    metrics.add("reconnects")
+    self.drop()
+    self.open()
+    if self.user is not None:
+      self.conn.login(self.user, self.passwd)
+      self.load_capabilities()
+    if self.selected:
+      self.select(self.mailbox)
+
+  def call_once(self, name, *args):
+    """Run an imaplib command
+    If the connection fails, it is dropped and the error raised. The next
+    command reconnects.
+    """
+    try:
+      if self.conn is None:
+        self.reconnect()
+      return getattr(self.conn, name)(*args)
+    except CONNECTION_ERRORS:
+      self.drop()
+      raise
+
+  def call(self, name, *args):
+    """Run an idempotent imaplib command
+    Tries again on a new connection if the connection fails
+    """
+    attempt = 0
+    while True:
+      try:
+        return self.call_once(name, *args)
+      except CONNECTION_ERRORS, e:
+        attempt += 1
+        if attempt > self.retries:
+          raise
+        self.wait_retry(name, attempt, e)
+
+  def wait_retry(self, name, attempt, error):
+    """Wait a little longer after each failed attempt
+    """
+    debug_print("%s failed (%s), retrying" % (name, error))
+    metrics.add("retries")
+    time.sleep(min(0.1 * 2 ** attempt, 5))
+
+  def has_capability(self, name):
+    """Check if the server supports an extension
+    """
+    if self.conn is None:
+      self.reconnect()
+    return name in self.capabilities
+
+  def load_capabilities(self):
+    """Ask the server for its extensions again
+    Many servers list some of them only once logged in
+    """
+    typ, data = self.conn.capability()
+    if typ == "OK" and data and data[-1]:
+      self.capabilities = tuple(data[-1].upper().split())
 
   def login(self, user, passwd):
     """Log in using user and passwd
     """
     self.conn.login(user, passwd)
+    self.user = user
+    self.passwd = passwd
+    self.load_capabilities()
 
   def logout(self):
     """Log out of the server
     """
-    self.conn.logout()
+    if self.conn is None:
+      return
+    try:
+      self.conn.logout()
+    except CONNECTION_ERRORS:
+      pass
 
-  def select(self, mailbox):
+  def new_block_name(self):
+    """Get a name for a new block
+    """
+    return str(uuid.uuid4())
+
+  def set_encryption(self, enc):
+    """Set the encryption used for messages
+    """
+    self.enc = enc
+
+  def select(self, mailbox, create=False):
     """Select a mailbox to use
+    If create is set, the mailbox is created if it does not exist
     """
     results = self.conn.select(mailbox)
+    if results[0] != "OK" and create:
+      self.conn.create(mailbox)
+      results = self.conn.select(mailbox)
     if results[0] != "OK":
       raise Exception()
+
+    uidvalidity = self.conn.response("UIDVALIDITY")[1][0]
+    if uidvalidity != self.uidvalidity:
+      self.uid_cache.clear()
+    self.uidvalidity = uidvalidity
     self.mailbox = mailbox
+    self.selected = True
+
+  def get_state(self):
+    """Get the state of the selected mailbox
+    Returns a tuple of UIDVALIDITY, UIDNEXT, MESSAGES and HIGHESTMODSEQ.
+    HIGHESTMODSEQ is None if the server does not support CONDSTORE.
+    Any change to the mailbox changes at least one of these.
+    """
+    items = "UIDVALIDITY UIDNEXT MESSAGES"
+    if self.has_capability("CONDSTORE"):
+      items += " HIGHESTMODSEQ"
+
+    results = self.call("status", self.mailbox, "(%s)" % items)
+    if results[0] != "OK":
+      raise Exception()
 
+    info = results[1][0]
+    state = []
+    for item in ("UIDVALIDITY", "UIDNEXT", "MESSAGES", "HIGHESTMODSEQ"):
+      match = re.search("%s ([0-9]+)" % item, info, re.I)
+      state.append(match.group(1) if match else None)
+    return tuple(state)
 
-  def get_message(self, uid):
+  def get_message(self, uid, encrypted=True):
     """Get a message's text by its UID
     Returns None if not found
     """
     if not uid:
       return None
 
-    params = self.conn.uid("FETCH", uid, "(BODY[1])")
-    if not params[1]:
+    start_time = time.time()
+    params = self.call("uid", "FETCH", uid, "(BODY[1])")
+    if not params[1] or params[1][0] is None:
       # Clear from cache
       for subject, s_uid in self.uid_cache.items():
         if s_uid == uid:
@@ -67,10 +266,73 @@ class IMAPConnection:
       return None
 
     data = params[1][0][1]
+    metrics.add_transfer("fetch", len(data), time.time() - start_time)
+    if not encrypted:
+      return data
     dec_data = self.enc.decrypt_message(data)
     return dec_data
 
-  def put_message(self, subject, data):
+  def get_messages(self, uids, encrypted=True):
+    """Get the text of many messages by their UIDs, one FETCH per batch
+    Returns a dict of UID to text. Messages that are not found are left
+    out.
+    """
+    uids = [str(uid) for uid in uids if uid]
+
+    messages = {}
+    for i in range(0, len(uids), BATCH_SIZE):
+      start_time = time.time()
+      results = self.call("uid", "FETCH", format_uid_set(uids[i:i + BATCH_SIZE]), "(BODY.PEEK[1])")
+      size = 0
+      for text, literals in parse_fetch(results[1]):
+        # Servers may add updates about other messages
+        match = re.search("UID ([0-9]+)", text)
+        if match and literals:
+          messages[match.group(1)] = literals[0]
+          size += len(literals[0])
+      metrics.add_transfer("fetch", size, time.time() - start_time)
+
+    # Clear missing ones from cache
+    missing = set(uids) - set(messages.keys())
+    for subject, s_uid in self.uid_cache.items():
+      if s_uid in missing:
+        self.uid_cache.pop(subject)
+
+    if encrypted:
+      for uid, data in messages.items():
+        messages[uid] = self.enc.decrypt_message(data)
+    return messages
+
+  def get_message_range(self, uid, offset, size):
+    """Get part of a message's text by its UID
+    Only the header and the chunks covering the range are fetched. Returns
+    None if not found, or if the message cannot be read in parts.
+    """
+    if not uid:
+      return None
+
+    # The header is the first line, the records start on a later one
+    first_index, start, length = self.enc.get_record_range(offset, size)
+    origin = start / imapenc.BASE64_UNIT * STORED_LINE
+    lines = (length + imapenc.BASE64_UNIT - 1) / imapenc.BASE64_UNIT
+    params = self.call("uid", "FETCH", uid, "(BODY.PEEK[1]<0.%d> BODY.PEEK[1]<%d.%d>)" % (
+        STORED_LINE, origin, lines * STORED_LINE))
+
+    messages = parse_fetch(params[1])
+    if not messages:
+      return None
+    text, literals = messages[0]
+    parts = dict(zip(re.findall("BODY\\[1\\]<([0-9]+)>", text, re.I), literals))
+    if "0" not in parts or str(origin) not in parts:
+      return None
+
+    try:
+      return self.enc.decrypt_range(parts["0"], parts[str(origin)], first_index, offset, size)
+    except ValueError:
+      # Stored differently than expected, the whole message will tell
+      return None
+
+  def put_message(self, subject, data, encrypted=True):
     """Store a message
     subject is stored as the message's subject
     """
@@ -79,12 +341,35 @@ class IMAPConnection:
     if subject in self.uid_cache:
       self.uid_cache.pop(subject)
 
-    enc_data = self.enc.encrypt_message(data)
+    if encrypted:
+      enc_data = self.enc.encrypt_message(data)
+    else:
+      enc_data = data
 
+    # The Message-ID tells whether an APPEND that failed midway was stored
+    msg_id = "<%s@imapfs>" % uuid.uuid4().hex
     msg = email.mime.text.MIMEText(enc_data)
     msg['Subject'] = subject
+    msg['Message-ID'] = msg_id
+    text = msg.as_string()
 
-    results = self.conn.append(self.mailbox, "(\\Seen \\Draft)", time.time(), msg.as_string())
+    attempt = 0
+    while True:
+      try:
+        start_time = time.time()
+        results = self.call_once("append", self.mailbox, "(\\Seen \\Draft)", time.time(), text)
+        metrics.add_transfer("append", len(text), time.time() - start_time)
+        break
+      except CONNECTION_ERRORS, e:
+        attempt += 1
+        if attempt > self.retries:
+          raise
+        self.wait_retry("APPEND", attempt, e)
+
+        uids = self.search("SUBJECT", "\"%s\"" % subject, "HEADER", "Message-ID", "\"%s\"" % msg_id)
+        if uids:
+          self.uid_cache[subject] = uids[-1]
+          return
 
     # Attempt to cache new UID
     # Requires the server to provide APPENDUID statement
@@ -98,7 +383,7 @@ class IMAPConnection:
   def delete_message(self, uid):
     """Delete a message by UID
     """
-    self.conn.uid("STORE", uid, "+FLAGS", "\\Deleted")
+    self.call("uid", "STORE", uid, "+FLAGS", "\\Deleted")
 
     # Invalidate cache
     for subject, s_uid in self.uid_cache.items():
@@ -107,14 +392,104 @@ class IMAPConnection:
 
     # self.conn.expunge()
 
+  def delete_messages(self, uids):
+    """Delete many messages by UID, one STORE per batch
+    """
+    uids = list(uids)
+    for i in range(0, len(uids), BATCH_SIZE):
+      self.call("uid", "STORE", format_uid_set(uids[i:i + BATCH_SIZE]), "+FLAGS", "\\Deleted")
+
+    # Invalidate cache
+    deleted = set(uids)
+    for subject, s_uid in self.uid_cache.items():
+      if s_uid in deleted:
+        self.uid_cache.pop(subject)
+
+  def expunge(self, uids=None):
+    """Permanently remove deleted messages
+    If uids is given and the server supports UIDPLUS, only those are removed.
+    Otherwise all deleted messages in the mailbox are.
+    """
+    if uids is not None and self.has_capability("UIDPLUS"):
+      uids = list(uids)
+      for i in range(0, len(uids), BATCH_SIZE):
+        self.call("uid", "EXPUNGE", format_uid_set(uids[i:i + BATCH_SIZE]))
+    else:
+      self.call("expunge")
+
+  def list_messages(self):
+    """List all messages in the mailbox
+    Returns a list of (uid, subject, size, deleted) tuples. Headers are
+    fetched in batches.
+    """
+    uids = self.search("ALL")
+
+    messages = []
+    for i in range(0, len(uids), BATCH_SIZE):
+      results = self.call("uid", "FETCH", format_uid_set(uids[i:i + BATCH_SIZE]),
+                              "(FLAGS RFC822.SIZE BODY.PEEK[HEADER.FIELDS (SUBJECT)])")
+      for text, literals in parse_fetch(results[1]):
+        uid = re.search("UID ([0-9]+)", text).group(1)
+        size = int(re.search("RFC822.SIZE ([0-9]+)", text).group(1))
+        deleted = re.search("FLAGS \\([^)]*\\\\Deleted", text, re.I) is not None
+        messages.append((uid, parse_subject(literals), size, deleted))
+    return messages
+
+  def get_new_messages(self, last_uid):
+    """List the messages added after the message with UID last_uid
+    Returns a list of (uid, subject) pairs
+    """
+    results = self.call("uid", "FETCH", "%d:*" % (int(last_uid) + 1),
+                        "(BODY.PEEK[HEADER.FIELDS (SUBJECT)])")
+    messages = []
+    for text, literals in parse_fetch(results[1]):
+      uid = re.search("UID ([0-9]+)", text).group(1)
+      # n:* always matches the last message, even if it is older
+      if int(uid) > int(last_uid):
+        messages.append((uid, parse_subject(literals)))
+    return messages
+
+  def idle(self, timeout):
+    """Wait until the server reports a change to the mailbox
+    Returns after at most timeout seconds. Needs the IDLE extension.
+    """
+    if self.conn is None:
+      self.reconnect()
+
+    try:
+      tag = self.conn._new_tag()
+      self.conn.send("%s IDLE\r\n" % tag)
+      if not self.conn.readline().startswith("+"):
+        raise imaplib.IMAP4.abort("IDLE refused")
+
+      # Any untagged response means something changed
+      self.conn.sock.settimeout(timeout)
+      try:
+        self.conn.readline()
+      except socket.error:
+        pass
+      self.conn.sock.settimeout(self.timeout)
+
+      self.conn.send("DONE\r\n")
+      while not self.conn.readline().startswith(tag):
+        pass
+    except CONNECTION_ERRORS:
+      self.drop()
+      raise
+
+  def search(self, *criteria):
+    """Returns a list of UIDs of messages matching criteria
+    """
+    results = self.call("uid", "SEARCH", *criteria)
+    if not results[1] or not results[1][0]:
+      return []
+    return results[1][0].split()
+
   def search_by_subject(self, subject):
     """Returns a list of UIDs of messages with given subject
     """
-    results = self.conn.uid("SEARCH", "SUBJECT", "\"%s\"" % subject)
-    if not results[1]:
-      return None
-    uids = results[1][0].split(" ")
-    if len(uids) == 1 and uids[0] == '':
+    uids = self.search("SUBJECT", "\"%s\"" % subject)
+    if not uids:
       return None
 
     return uids
@@ -133,3 +508,18 @@ class IMAPConnection:
     self.uid_cache[subject] = results[-1]
 
     return results[-1]
+
+  def forget_subject(self, subject):
+    """Drop the cached UID of subject
+    """
+    self.uid_cache.pop(subject, None)
+
+  def clear_cache(self):
+    """Drop all cached UIDs
+    """
+    self.uid_cache.clear()
+
+  def get_connections(self):
+    """Get the connections to each mailbox that holds the filesystem
+    """
+    return [self]
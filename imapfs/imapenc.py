@@ -17,25 +17,83 @@
 from Crypto.Cipher import AES
 from Crypto.Protocol.KDF import PBKDF2
 from Crypto.Random import get_random_bytes
+from Crypto.Util import Counter
 
 import bz2
+import hashlib
+import hmac
+import struct
+
+from imapfs.debug_print import debug_print
 
 AES_KEY_SIZE = 32
 AES_BLOCK_SIZE = AES.block_size
+SALT_SIZE = 16
+
+# Salt used by filesystems created before salts were stored on the server
+LEGACY_SALT = "just a random salt"
+
+# Message format 1 is a header record followed by chunk records. Each chunk
+# is encrypted with AES-CTR and carries a truncated HMAC-SHA256 tag, so it
+# can be checked and decrypted on its own. Records are multiples of 57
+# bytes, which base64 encodes to whole 76 character lines, so the position
+# of a record in the encoded message can be computed.
+# Messages without the header are in the original AES-CBC format.
+FORMAT_MAGIC = "IMFS"
+FORMAT_VERSION = 1
+BASE64_UNIT = 57
+HEADER_SIZE = BASE64_UNIT
+NONCE_SIZE = 12
+TAG_SIZE = 16
+CHUNK_RECORD_SIZE = BASE64_UNIT * 72
+CHUNK_SIZE = CHUNK_RECORD_SIZE - TAG_SIZE
+# AES blocks set aside for each chunk in the CTR counter
+CHUNK_COUNTER_STEP = 256
+# Characters of base64 per BASE64_UNIT bytes, one line
+BASE64_LINE = 76
 
 class IMAPEnc:
   """Class that handles crypto functions
   """
 
-  def __init__(self, passwd, iterations=10000):
-    salt = "just a random salt"
-    self.key = PBKDF2(passwd, salt, AES_KEY_SIZE, iterations)
+  def __init__(self, passwd, iterations=10000, salt=LEGACY_SALT, key=None):
+    """Derives the key from passwd
+    If key is given, it is used instead and no derivation is done
+    """
+    self.salt = salt
+    self.iterations = iterations
+    if key is None:
+      key = PBKDF2(passwd, salt, AES_KEY_SIZE, iterations)
+    self.key = key
+
+    # Separate keys for encryption and authentication
+    self.enc_key = hmac.new(key, "imapfs encryption", hashlib.sha256).digest()
+    self.mac_key = hmac.new(key, "imapfs authentication", hashlib.sha256).digest()
+
+  def format_params(self):
+    """Return the key derivation parameters to be stored on the server
+    """
+    return "p\r\n%s\t%d\r\n" % (self.salt.encode("hex"), self.iterations)
+
+  @staticmethod
+  def parse_params(data):
+    """Parse stored key derivation parameters
+    Returns the salt and the iteration count
+    """
+    info = str(data).split("\r\n")[1].split("\t")
+    return info[0].decode("hex"), int(info[1])
+
+  @staticmethod
+  def new_salt():
+    """Return a random salt for a new filesystem
+    """
+    return get_random_bytes(SALT_SIZE)
 
   def compress(self, data):
     """Compress data
     """
     compressed = bz2.compress(data)
-    print "Compressed %d bytes to %d (%.2f)" % (len(data), len(compressed), float(len(compressed)) / len(data))
+    debug_print("Compressed %d bytes to %d (%.2f)" % (len(data), len(compressed), float(len(compressed)) / max(len(data), 1)))
     return compressed
 
   def decompress(self, data):
@@ -43,20 +101,28 @@ class IMAPEnc:
     """
     return bz2.decompress(data)
 
-  def pad(self, data):
-    """Return data padded to AES blocksize
+  def get_pad(self, data):
+    """Return the padding that brings data to the AES blocksize
     """
     plain_len = len(data) + 1
     padded_len = plain_len / AES_BLOCK_SIZE * AES_BLOCK_SIZE + (AES_BLOCK_SIZE if plain_len % AES_BLOCK_SIZE > 0 else 0)
     pad_len = padded_len - len(data)
 
-    return data + chr(pad_len) * pad_len
+    return chr(pad_len) * pad_len
+
+  def pad(self, data):
+    """Return data padded to AES blocksize
+    """
+    return data + self.get_pad(data)
 
   def unpad(self, data):
     """Return data with padding stripped
+    Returns a buffer of data, without copying
     """
     pad_len = ord(data[-1])
-    return data[:-pad_len]
+    if pad_len < 1 or pad_len > len(data):
+      raise ValueError("Bad padding")
+    return buffer(data, 0, len(data) - pad_len)
 
   def encode(self, data):
     """Return data base64-encoded
@@ -70,25 +136,134 @@ class IMAPEnc:
 
   def encrypt(self, data):
     """Return data AES encrypted
+    data must be a multiple of the blocksize
     """
     iv = get_random_bytes(AES_BLOCK_SIZE)
     aes = AES.new(self.key, mode=AES.MODE_CBC, IV=iv)
-    return iv + aes.encrypt(data)
+    return iv + aes.encrypt(buffer(data))
 
   def decrypt(self, data):
     """Return data AES decrypted
     """
     iv = data[0:AES_BLOCK_SIZE]
-    ciphertext = data[AES_BLOCK_SIZE:]
+    ciphertext = buffer(data, AES_BLOCK_SIZE)
     aes = AES.new(self.key, mode=AES.MODE_CBC, IV=iv)
     return aes.decrypt(ciphertext)
 
+  def get_tag(self, *parts):
+    """Return the truncated HMAC of parts
+    """
+    mac = hmac.new(self.mac_key, digestmod=hashlib.sha256)
+    for part in parts:
+      mac.update(part)
+    return mac.digest()[:TAG_SIZE]
+
+  def crypt_chunk(self, nonce, index, data):
+    """Encrypt or decrypt a chunk, which is the same in CTR mode
+    """
+    counter = Counter.new(32, prefix=nonce, initial_value=index * CHUNK_COUNTER_STEP)
+    return AES.new(self.enc_key, AES.MODE_CTR, counter=counter).encrypt(data)
+
+  def get_chunk_tag(self, nonce, index, last, ciphertext):
+    """Return the tag of a chunk
+    It covers the chunk's position, so chunks cannot be moved, and marks the
+    last chunk, so a message cannot be cut short
+    """
+    return self.get_tag(nonce, struct.pack(">QB", index, last), ciphertext)
+
+  def parse_header(self, data):
+    """Parse the header of a format 1 message
+    Returns the nonce and the length of the plaintext, or None if data is in
+    the original format or the header does not check out
+    """
+    if len(data) < HEADER_SIZE or data[0:len(FORMAT_MAGIC)] != FORMAT_MAGIC:
+      return None
+
+    header = str(buffer(data, 0, HEADER_SIZE - TAG_SIZE))
+    if self.get_tag(header) != data[HEADER_SIZE - TAG_SIZE:HEADER_SIZE]:
+      return None
+
+    magic, version, nonce, length = struct.unpack(">4sB12sQ", header[0:25])
+    if version != FORMAT_VERSION:
+      return None
+    return nonce, length
+
+  def encrypt_chunks(self, data):
+    """Return data encrypted in format 1, not encoded
+    """
+    nonce = get_random_bytes(NONCE_SIZE)
+    header = struct.pack(">4sB12sQ", FORMAT_MAGIC, FORMAT_VERSION, nonce, len(data))
+    header += "\0" * (HEADER_SIZE - TAG_SIZE - len(header))
+    parts = [header, self.get_tag(header)]
+
+    count = (len(data) + CHUNK_SIZE - 1) / CHUNK_SIZE
+    for index in range(count):
+      ciphertext = self.crypt_chunk(nonce, index, buffer(data, index * CHUNK_SIZE, CHUNK_SIZE))
+      parts.append(ciphertext)
+      parts.append(self.get_chunk_tag(nonce, index, index == count - 1, ciphertext))
+    return "".join(parts)
+
+  def decrypt_chunks(self, records, nonce, first_index, length):
+    """Check and decrypt consecutive chunk records
+    records starts with chunk first_index, length is the length of the
+    whole plaintext. Raises ValueError if a chunk was changed.
+    """
+    count = (length + CHUNK_SIZE - 1) / CHUNK_SIZE
+    parts = []
+    for offset in range(0, len(records), CHUNK_RECORD_SIZE):
+      index = first_index + offset / CHUNK_RECORD_SIZE
+      record = buffer(records, offset, CHUNK_RECORD_SIZE)
+      if len(record) <= TAG_SIZE:
+        raise ValueError("Bad chunk")
+      ciphertext = record[0:len(record) - TAG_SIZE]
+      if self.get_chunk_tag(nonce, index, index == count - 1, ciphertext) != record[len(record) - TAG_SIZE:]:
+        raise ValueError("Bad tag")
+      parts.append(self.crypt_chunk(nonce, index, ciphertext))
+    return "".join(parts)
+
+  def get_record_range(self, offset, size):
+    """Find the chunk records holding part of a format 1 message
+    Returns the index of the first chunk, and the offset and length of the
+    records in the unencoded message. They start and end on base64 lines.
+    """
+    first_index = offset / CHUNK_SIZE
+    last_index = (offset + max(size, 1) - 1) / CHUNK_SIZE
+    start = HEADER_SIZE + first_index * CHUNK_RECORD_SIZE
+    return first_index, start, (last_index + 1 - first_index) * CHUNK_RECORD_SIZE
+
+  def decrypt_range(self, header, records, first_index, offset, size):
+    """Decrypt part of a format 1 message
+    header and records are the encoded header line and records found with
+    get_record_range. Returns None if the message is in the original
+    format, which cannot be read in parts.
+    """
+    header = self.parse_header(self.decode(header))
+    if header is None:
+      return None
+
+    nonce, length = header
+    plaintext = self.decrypt_chunks(self.decode(records), nonce, first_index, length)
+    start = offset - first_index * CHUNK_SIZE
+    return plaintext[start:start + size]
+
   def encrypt_message(self, data):
-    """Returns data padded, encrypted, and encoded
+    """Returns data encrypted in format 1, and encoded
+    data may be any buffer
     """
-    return self.encode(self.encrypt(self.pad(data)))
+    return self.encode(self.encrypt_chunks(data))
 
   def decrypt_message(self, data):
-    """Returns data decrypted. Handles padding and encoding.
+    """Returns data decrypted. Handles both formats and the encoding.
+    Returns a str or a buffer. Raises ValueError if the data was changed
+    or the key is wrong.
     """
-    return self.unpad(self.decrypt(self.decode(data)))
+    data = self.decode(data)
+    header = self.parse_header(data)
+    if header is None:
+      return self.unpad(self.decrypt(data))
+
+    nonce, length = header
+    plaintext = self.decrypt_chunks(buffer(data, HEADER_SIZE), nonce, 0, length)
+    if len(plaintext) != length:
+      raise ValueError("Bad length")
+    return plaintext
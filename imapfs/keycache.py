@@ -0,0 +1,79 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import subprocess
+
+from imapfs.debug_print import debug_print
+
+
+# Caches derived keys in the user's kernel keyring using keyctl(1), so that
+# remounts can skip PBKDF2. Keys never touch the disk and expire after
+# the timeout. If keyctl is not available, nothing is cached. While a key
+# is cached, the filesystem it belongs to mounts without checking the
+# password.
+
+def get_description(salt, iterations, account):
+  """Get the keyring description for a key
+  Only public values go into it: the filesystem's salt and iteration count,
+  and the account it is on. Anything derived cheaply from the password
+  would let whoever can list the keyring test guesses without PBKDF2.
+  """
+  digest = hashlib.sha256("%s\t%d\t%s" % (salt, iterations, account))
+  return "imapfs:%s" % digest.hexdigest()
+
+
+def run_keyctl(args, stdin=None):
+  """Run keyctl and return its output
+  Returns None on failure
+  """
+  try:
+    devnull = open(os.devnull, "w")
+    try:
+      proc = subprocess.Popen(["keyctl"] + args, stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE, stderr=devnull)
+      output = proc.communicate(stdin)[0]
+    finally:
+      devnull.close()
+  except OSError:
+    return None
+
+  if proc.returncode != 0:
+    return None
+  return output
+
+
+def get_key(salt, iterations, account):
+  """Get a cached key
+  Returns None if not cached
+  """
+  key_id = run_keyctl(["search", "@u", "user", get_description(salt, iterations, account)])
+  if not key_id:
+    return None
+
+  return run_keyctl(["pipe", key_id.strip()])
+
+
+def put_key(salt, iterations, account, key, timeout):
+  """Cache a key for timeout seconds
+  """
+  key_id = run_keyctl(["padd", "user", get_description(salt, iterations, account), "@u"], key)
+  if not key_id:
+    debug_print("Could not cache key, is keyctl installed?")
+    return
+
+  run_keyctl(["timeout", key_id.strip(), str(int(timeout))])
@@ -17,6 +17,7 @@
 import exceptions
 import os
 import uuid
+from imapfs import spool
 from imapfs.debug_print import debug_print
 
 
@@ -25,12 +26,41 @@ class Message:
   """
 
   def __init__(self, conn, name, data):
+    """data is used without copying
+    Immutable data (str or buffer) is only copied on the first change
+    """
     self.conn = conn
     self.name = name
-    self.data = bytearray(data)
+    self.data = data
     self.dirty = False
     self.pos = 0
     self.compress = False
+    self.spool_dir = None
+
+  def make_writable(self):
+    """Copy immutable data into a bytearray so it can be changed
+    Messages using a spool get a SpoolBuffer instead
+    """
+    if isinstance(self.data, (bytearray, spool.SpoolBuffer)):
+      return
+    if self.spool_dir:
+      self.data = spool.SpoolBuffer(self.spool_dir, self.data)
+    else:
+      self.data = bytearray(self.data)
+
+  def use_spool(self, directory):
+    """Keep the data in a memory-mapped file in directory from now on
+    """
+    self.spool_dir = directory
+    if not isinstance(self.data, spool.SpoolBuffer):
+      self.data = spool.SpoolBuffer(directory, self.data)
+
+  def view(self, start, size):
+    """Get a view of part of the data, without copying it
+    """
+    if isinstance(self.data, spool.SpoolBuffer):
+      return self.data.view(start, size)
+    return memoryview(self.data)[start:start + size]
 
   def seek(self, off, whence=os.SEEK_SET):
     """Seek in the message
@@ -44,18 +74,23 @@ class Message:
 
   def read(self, size=None):
     """Read from the message
+    Returns a view of the message data
     """
-    if size is None:
-      buf = self.data[self.pos:]
-      self.pos += len(buf)
-      return buf
-    else:
-      if size + self.pos > len(self.data):
-        size = len(self.data) - self.pos
+    if size is None or size + self.pos > len(self.data):
+      size = max(len(self.data) - self.pos, 0)
 
-      buf = self.data[self.pos:self.pos + size]
-      self.pos += size
-      return buf
+    buf = self.view(self.pos, size)
+    self.pos += size
+    return buf
+
+  def readinto(self, buf):
+    """Read from the message into a writable buffer
+    Returns the number of bytes read
+    """
+    size = min(len(buf), max(len(self.data) - self.pos, 0))
+    memoryview(buf)[0:size] = self.view(self.pos, size)
+    self.pos += size
+    return size
 
   def truncate(self, size=None):
     """Resize the message
@@ -63,28 +98,38 @@ class Message:
     if size is None:
       return
 
+    self.make_writable()
     if len(self.data) > size:
-      self.data = self.data[:size]
+      del self.data[size:]
       if self.pos > size:
         self.pos = size
     else:
-      self.data += "." * (size - len(self.data))
+      self.data += "\0" * (size - len(self.data))
 
     self.dirty = True
 
+  def is_zero(self):
+    """Check if the message holds only zero bytes
+    """
+    return self.data.count("\0") == len(self.data)
+
   def write(self, buf):
     """Write to the message
+    buf may be any buffer, including a memoryview
     """
     if self.pos + len(buf) > len(self.data):
       # Resize to fit
       self.truncate(self.pos + len(buf))
 
+    self.make_writable()
     self.data[self.pos:self.pos + len(buf)] = buf
     self.pos += len(buf)
     self.dirty = True
 
-  def flush(self):
+  def flush(self, encoded=None):
     """Write any changes to the server
+    encoded is the data already compressed and encrypted, if a worker
+    did that
     """
     if self.dirty:
       debug_print("Flushing %d bytes" % len(self.data))
@@ -93,13 +138,16 @@ class Message:
       old_uid = self.conn.get_uid_by_subject(self.name)
 
       # Store message
-      # Compress, if requested
-      if self.compress:
-        data_str = self.conn.enc.compress(str(self.data))
+      if encoded is not None:
+        self.conn.put_message(self.name, encoded, encrypted=False)
       else:
-        data_str = str(self.data)
+        # Compress, if requested
+        if self.compress:
+          data_str = self.conn.enc.compress(spool.get_buffer(self.data))
+        else:
+          data_str = spool.get_buffer(self.data)
 
-      self.conn.put_message(self.name, data_str)
+        self.conn.put_message(self.name, data_str)
 
       # Delete old version
       if old_uid:
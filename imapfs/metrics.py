@@ -0,0 +1,112 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Counters and latency statistics, readable from /.imapfs/stats on a mount
+
+import collections
+import threading
+
+
+counters = {}
+trackers = {}
+gauges = {}
+lock = threading.Lock()
+
+# Transfers at least this big tell the bandwidth, smaller ones the round
+# trip time
+RATE_MIN_SIZE = 65536
+ROUND_TRIP_MAX_SIZE = 4096
+
+
+def add(name, count=1):
+  """Add to a counter
+  """
+  with lock:
+    counters[name] = counters.get(name, 0) + count
+
+
+def get(name):
+  """Get the value of a counter
+  """
+  return counters.get(name, 0)
+
+
+def add_gauge(name, func):
+  """Add a value that is read by calling func when metrics are formatted
+  """
+  with lock:
+    gauges[name] = func
+
+
+def get_tracker(name):
+  """Get the latency tracker called name, creating it if needed
+  """
+  with lock:
+    if name not in trackers:
+      trackers[name] = LatencyTracker()
+    return trackers[name]
+
+
+def add_transfer(name, size, seconds):
+  """Record the size and duration of a transfer
+  Large transfers go to the name_rate tracker, in bytes per second, and
+  small ones to the round_trip tracker
+  """
+  if size >= RATE_MIN_SIZE:
+    get_tracker(name + "_rate").add(size / max(seconds, 0.000001))
+  elif size <= ROUND_TRIP_MAX_SIZE:
+    get_tracker("round_trip").add(seconds)
+
+
+def format_metrics():
+  """Format all counters and latencies, one per line
+  """
+  lines = []
+  for name, value in sorted(counters.items()):
+    lines.append("%s %d\n" % (name, value))
+  for name, func in sorted(gauges.items()):
+    lines.append("%s %d\n" % (name, func()))
+  for name, tracker in sorted(trackers.items()):
+    for fraction in (0.5, 0.95, 0.99):
+      value = tracker.percentile(fraction)
+      if value is not None:
+        lines.append("%s_p%d %.4f\n" % (name, fraction * 100, value))
+  return "".join(lines)
+
+
+class LatencyTracker:
+  """Keeps the most recent latencies to estimate percentiles
+  """
+
+  def __init__(self, size=200):
+    self.samples = collections.deque(maxlen=size)
+    self.lock = threading.Lock()
+
+  def add(self, seconds):
+    """Record a latency
+    """
+    with self.lock:
+      self.samples.append(seconds)
+
+  def percentile(self, fraction, min_samples=1):
+    """Get a percentile of the recent latencies
+    Returns None until there are at least min_samples of them
+    """
+    with self.lock:
+      if len(self.samples) < min_samples:
+        return None
+      samples = sorted(self.samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
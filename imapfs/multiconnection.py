@@ -0,0 +1,537 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import Queue
+import threading
+import time
+import uuid
+
+from imapfs import imapconnection, metrics
+
+
+class MultiConnection:
+  """Spreads messages over several connections
+  Works like IMAPConnection. UIDs are returned as "index:uid", so that they
+  can be routed back to the connection they came from. Subclasses choose
+  the connection for a subject by overriding get_index.
+  """
+
+  def __init__(self, conns):
+    self.conns = conns
+    self.enc = None
+    self.uid_cache = {}
+
+  def get_index(self, subject):
+    """Get the index of the connection that stores subject
+    Everything is on the first one unless a subclass spreads it out
+    """
+    return 0
+
+  def make_uid(self, index, uid):
+    """Combine a connection index and a UID
+    """
+    if uid is None:
+      return None
+    return "%d:%s" % (index, uid)
+
+  def split_uid(self, uid):
+    """Split a combined UID into a connection and a UID
+    """
+    index, conn_uid = uid.split(":", 1)
+    return self.conns[int(index)], conn_uid
+
+  def group_uids(self, uids):
+    """Group combined UIDs by connection
+    Returns a list of (connection, uids) pairs
+    """
+    groups = {}
+    for uid in uids:
+      index, conn_uid = uid.split(":", 1)
+      groups.setdefault(int(index), []).append(conn_uid)
+    return [(self.conns[index], conn_uids) for index, conn_uids in groups.items()]
+
+  def forget_uids(self, uids):
+    """Invalidate cached UIDs
+    """
+    uids = set(uids)
+    for subject, s_uid in self.uid_cache.items():
+      if s_uid in uids:
+        self.uid_cache.pop(subject)
+
+  def forget_subject(self, subject):
+    """Drop the cached UID of subject
+    """
+    self.uid_cache.pop(subject, None)
+    for conn in self.conns:
+      conn.forget_subject(subject)
+
+  def clear_cache(self):
+    """Drop all cached UIDs
+    """
+    self.uid_cache.clear()
+    for conn in self.conns:
+      conn.clear_cache()
+
+  def get_connections(self):
+    """Get the connections to each mailbox that holds the filesystem
+    """
+    conns = []
+    for conn in self.conns:
+      conns += conn.get_connections()
+    return conns
+
+  def new_block_name(self):
+    """Get a name for a new block
+    """
+    return str(uuid.uuid4())
+
+  def set_encryption(self, enc):
+    """Set the encryption used by all connections
+    """
+    self.enc = enc
+    for conn in self.conns:
+      conn.set_encryption(enc)
+
+  def login(self, user, passwd):
+    """Log in on all connections
+    """
+    for conn in self.conns:
+      conn.login(user, passwd)
+
+  def logout(self):
+    """Log out of all connections
+    """
+    for conn in self.conns:
+      conn.logout()
+
+  def get_state(self):
+    """Get the state of all mailboxes
+    """
+    state = ()
+    for conn in self.conns:
+      state += conn.get_state()
+    return state
+
+  def get_message(self, uid, encrypted=True):
+    """Get a message's text by its UID
+    Returns None if not found
+    """
+    if not uid:
+      return None
+
+    conn, conn_uid = self.split_uid(uid)
+    data = conn.get_message(conn_uid, encrypted)
+    if data is None:
+      self.forget_uids([uid])
+    return data
+
+  def get_messages(self, uids, encrypted=True):
+    """Get the text of many messages by their UIDs
+    One batch is fetched from each connection that holds any of them.
+    Returns a dict of UID to text, without the messages not found.
+    """
+    uids = [uid for uid in uids if uid]
+
+    groups = {}
+    for uid in uids:
+      index, conn_uid = uid.split(":", 1)
+      groups.setdefault(int(index), []).append(conn_uid)
+
+    messages = {}
+    for index, conn_uids in groups.items():
+      for conn_uid, data in self.conns[index].get_messages(conn_uids, encrypted).items():
+        messages[self.make_uid(index, conn_uid)] = data
+
+    self.forget_uids(set(uids) - set(messages.keys()))
+    return messages
+
+  def get_message_range(self, uid, offset, size):
+    """Get part of a message's text by its UID
+    Returns None if not found, or if the message cannot be read in parts
+    """
+    if not uid:
+      return None
+
+    conn, conn_uid = self.split_uid(uid)
+    return conn.get_message_range(conn_uid, offset, size)
+
+  def put_message(self, subject, data, encrypted=True):
+    """Store a message
+    """
+    if subject in self.uid_cache:
+      self.uid_cache.pop(subject)
+
+    index = self.get_index(subject)
+    conn = self.conns[index]
+    conn.put_message(subject, data, encrypted)
+    if subject in conn.uid_cache:
+      self.uid_cache[subject] = self.make_uid(index, conn.uid_cache[subject])
+
+  def delete_message(self, uid):
+    """Delete a message by UID
+    """
+    conn, conn_uid = self.split_uid(uid)
+    conn.delete_message(conn_uid)
+    self.forget_uids([uid])
+
+  def delete_messages(self, uids):
+    """Delete many messages by UID
+    """
+    for conn, conn_uids in self.group_uids(uids):
+      conn.delete_messages(conn_uids)
+    self.forget_uids(uids)
+
+  def expunge(self, uids=None):
+    """Permanently remove deleted messages
+    """
+    if uids is None:
+      for conn in self.conns:
+        conn.expunge()
+    else:
+      for conn, conn_uids in self.group_uids(uids):
+        conn.expunge(conn_uids)
+
+  def list_messages(self):
+    """List all messages in all mailboxes
+    """
+    messages = []
+    for index, conn in enumerate(self.conns):
+      for uid, subject, size, deleted in conn.list_messages():
+        messages.append((self.make_uid(index, uid), subject, size, deleted))
+    return messages
+
+  def search_by_subject(self, subject):
+    """Returns a list of UIDs of messages with given subject
+    """
+    index = self.get_index(subject)
+    uids = self.conns[index].search_by_subject(subject)
+    if not uids:
+      return None
+    return [self.make_uid(index, uid) for uid in uids]
+
+  def get_uid_by_subject(self, subject):
+    """Get the UID of a single message with subject subject
+    """
+    if subject in self.uid_cache:
+      return self.uid_cache[subject]
+
+    index = self.get_index(subject)
+    uid = self.make_uid(index, self.conns[index].get_uid_by_subject(subject))
+    if uid:
+      self.uid_cache[subject] = uid
+    return uid
+
+
+class ShardedConnection(MultiConnection):
+  """Spreads messages over several mailboxes by a hash of their subject
+  Each mailbox gets its own connection, so lookups go straight to the
+  right mailbox. The number of shards must not change once a filesystem
+  has been created.
+  """
+
+  def __init__(self, host, port, enc, shards, timeout=imapconnection.DEFAULT_TIMEOUT, retries=imapconnection.DEFAULT_RETRIES):
+    MultiConnection.__init__(self, [imapconnection.IMAPConnection(host, port, enc, timeout, retries) for i in range(shards)])
+    self.enc = enc
+
+  def get_index(self, subject):
+    return int(hashlib.md5(subject).hexdigest()[:8], 16) % len(self.conns)
+
+  def select(self, mailbox):
+    """Select the shard mailboxes, creating any that are missing
+    Shards are named mailbox.0, mailbox.1 and so on
+    """
+    for index, conn in enumerate(self.conns):
+      conn.select("%s.%d" % (mailbox, index), create=True)
+
+
+class StripedConnection(MultiConnection):
+  """Stripes blocks over several accounts
+  The first connection is the primary, which holds all metadata. New
+  blocks go to each connection in turn, and their names record which one
+  holds them, as name@index. The order of the backends must not change.
+  """
+
+  def __init__(self, primary, backends):
+    """backends is a list of (connection, user, password, mailbox) tuples
+    """
+    MultiConnection.__init__(self, [primary] + [backend[0] for backend in backends])
+    self.backends = backends
+    self.next_index = 0
+
+  def get_index(self, subject):
+    name, sep, index = subject.partition("@")
+    if not sep:
+      return 0
+    return int(index)
+
+  def new_block_name(self):
+    """Get a name for a new block on the next connection in turn
+    """
+    index = self.next_index
+    self.next_index = (index + 1) % len(self.conns)
+
+    name = self.conns[index].new_block_name()
+    if index:
+      name += "@%d" % index
+    return name
+
+  def login(self, user, passwd):
+    """Log in to the primary with user and passwd, and to the other
+    backends with their own accounts
+    """
+    self.conns[0].login(user, passwd)
+    for conn, backend_user, backend_passwd, mailbox in self.backends:
+      conn.login(backend_user, backend_passwd)
+
+  def select(self, mailbox):
+    """Select mailbox on the primary, and the configured mailboxes on the
+    other backends
+    """
+    self.conns[0].select(mailbox)
+    for conn, backend_user, backend_passwd, backend_mailbox in self.backends:
+      conn.select(backend_mailbox, create=True)
+
+
+class LockedConnection:
+  """Wraps a connection so that only one thread uses it at a time
+  """
+
+  def __init__(self, conn):
+    self.conn = conn
+    self.lock = threading.Lock()
+
+  def __getattr__(self, name):
+    attr = getattr(self.conn, name)
+    if not callable(attr):
+      return attr
+
+    def call(*args, **kwargs):
+      with self.lock:
+        return attr(*args, **kwargs)
+    return call
+
+  def is_busy(self):
+    """Check if another thread is using the connection
+    """
+    return self.lock.locked()
+
+
+class ReplicatedConnection(MultiConnection):
+  """Keeps a copy of every message on a replica
+  Writes go to both connections. Reads go to the primary, and are hedged:
+  if the primary has not answered within its recent 95th percentile
+  latency, the message is fetched from the replica too, and whichever
+  answers first is used. The replica is a complete copy of the filesystem.
+  """
+
+  # Hedge delay used until enough latencies have been seen
+  DEFAULT_HEDGE_DELAY = 1.0
+  MIN_SAMPLES = 20
+
+  def __init__(self, primary, replica, replica_user, replica_passwd, replica_mailbox):
+    MultiConnection.__init__(self, [LockedConnection(primary), LockedConnection(replica)])
+    self.replica_user = replica_user
+    self.replica_passwd = replica_passwd
+    self.replica_mailbox = replica_mailbox
+    self.subjects = {}
+    self.latency = metrics.get_tracker("fetch_latency")
+
+  def get_index(self, subject):
+    return 0
+
+  def new_block_name(self):
+    return self.conns[0].new_block_name()
+
+  def login(self, user, passwd):
+    """Log in to the primary with user and passwd, and to the replica with
+    its own account
+    """
+    self.conns[0].login(user, passwd)
+    self.conns[1].login(self.replica_user, self.replica_passwd)
+
+  def select(self, mailbox):
+    """Select mailbox on the primary, and the replica's mailbox
+    """
+    self.conns[0].select(mailbox)
+    self.conns[1].select(self.replica_mailbox, create=True)
+
+  def get_hedge_delay(self):
+    """Get how long to wait for the primary before asking the replica
+    """
+    # Do not queue up behind a fetch that was given up on
+    if self.conns[0].is_busy():
+      return 0
+    delay = self.latency.percentile(0.95, self.MIN_SAMPLES)
+    if delay is None:
+      return self.DEFAULT_HEDGE_DELAY
+    return delay
+
+  def fetch(self, index, uids, subjects, encrypted, results):
+    """Fetch messages from one of the connections
+    Puts (index, messages, error) on results, where messages maps the
+    primary's UIDs to their text
+    """
+    start_time = time.time()
+    try:
+      if index == 0:
+        conn = self.conns[0]
+        fetched = conn.get_messages([self.split_uid(uid)[1] for uid in uids], encrypted)
+        messages = dict([(self.make_uid(0, conn_uid), data) for conn_uid, data in fetched.items()])
+        # Batches take longer, and would make single reads hedge late
+        if len(uids) == 1:
+          self.latency.add(time.time() - start_time)
+      else:
+        replica = self.conns[1]
+        replica_uids = [replica.get_uid_by_subject(subject) for subject in subjects]
+        fetched = replica.get_messages([replica_uid for replica_uid in replica_uids if replica_uid], encrypted)
+        messages = {}
+        for uid, subject, replica_uid in zip(uids, subjects, replica_uids):
+          if not replica_uid or replica_uid not in fetched:
+            raise IOError("%s is missing on the replica" % subject)
+          messages[uid] = fetched[replica_uid]
+      results.put((index, messages, None))
+    except Exception, e:
+      results.put((index, None, e))
+
+  def start_fetch(self, index, uids, subjects, encrypted, results):
+    """Fetch messages in the background
+    """
+    thread = threading.Thread(target=self.fetch, args=(index, uids, subjects, encrypted, results))
+    thread.daemon = True
+    thread.start()
+
+  def get_message(self, uid, encrypted=True):
+    """Get a message's text by its UID
+    Returns None if not found
+    """
+    if not uid:
+      return None
+    return self.get_messages([uid], encrypted).get(uid)
+
+  def get_messages(self, uids, encrypted=True):
+    """Get the text of many messages by their UIDs
+    Returns a dict of UID to text, without the messages not found. A batch
+    is hedged as a whole, after waiting as long for the primary as for
+    that many single reads. The slower of the two fetches is left to
+    finish in the background, and its result is dropped.
+    """
+    uids = [uid for uid in uids if uid]
+    subjects = [self.subjects.get(uid) for uid in uids]
+    if not uids or None in subjects:
+      return MultiConnection.get_messages(self, uids, encrypted)
+
+    metrics.add("reads", len(uids))
+    delay = self.get_hedge_delay() * len(uids)
+    results = Queue.Queue()
+    self.start_fetch(0, uids, subjects, encrypted, results)
+    pending = 1
+    hedged = False
+
+    while True:
+      try:
+        index, messages, error = results.get(True, None if hedged else delay)
+        pending -= 1
+      except Queue.Empty:
+        index, error = None, None
+
+      if index is not None and error is None:
+        if index:
+          metrics.add("hedge_wins")
+        else:
+          self.forget_uids(set(uids) - set(messages.keys()))
+        return messages
+
+      if hedged and not pending:
+        raise error
+
+      # The primary is slow or failed, ask the replica
+      if not hedged:
+        metrics.add("hedged_reads")
+        hedged = True
+        pending += 1
+        self.start_fetch(1, uids, subjects, encrypted, results)
+
+  def put_message(self, subject, data, encrypted=True):
+    """Store a message on both connections at once
+    The replica replaces its old copy itself
+    """
+    if encrypted:
+      data = self.enc.encrypt_message(data)
+
+    # The primary's old copy is deleted by the caller, and must not take
+    # the replica's new copy with it
+    old_uid = self.uid_cache.get(subject)
+    if old_uid in self.subjects:
+      self.subjects.pop(old_uid)
+
+    errors = []
+    thread = threading.Thread(target=self.put_replica, args=(subject, data, errors))
+    thread.start()
+    try:
+      MultiConnection.put_message(self, subject, data, False)
+    finally:
+      thread.join()
+    if errors:
+      raise errors[0]
+
+    if subject in self.uid_cache:
+      self.subjects[self.uid_cache[subject]] = subject
+
+  def put_replica(self, subject, data, errors):
+    """Store an encrypted message on the replica, replacing any old copy
+    """
+    replica = self.conns[1]
+    try:
+      old_uid = replica.get_uid_by_subject(subject)
+      replica.put_message(subject, data, False)
+      if old_uid:
+        replica.delete_message(old_uid)
+    except Exception, e:
+      errors.append(e)
+
+  def delete_message(self, uid):
+    """Delete a message by UID
+    If it is the current copy, the replica's copy is deleted too
+    """
+    MultiConnection.delete_message(self, uid)
+
+    subject = self.subjects.pop(uid, None)
+    if subject is not None:
+      replica = self.conns[1]
+      replica_uid = replica.get_uid_by_subject(subject)
+      if replica_uid:
+        replica.delete_message(replica_uid)
+
+  def list_messages(self):
+    """List all messages on the primary
+    """
+    return [(self.make_uid(0, uid), subject, size, deleted)
+            for uid, subject, size, deleted in self.conns[0].list_messages()]
+
+  def get_connections(self):
+    """Get the connections to the primary's mailboxes
+    The replica holds the same messages
+    """
+    return self.conns[0].get_connections()
+
+  def get_uid_by_subject(self, subject):
+    """Get the UID of a single message with subject subject
+    """
+    uid = MultiConnection.get_uid_by_subject(self, subject)
+    if uid:
+      self.subjects[uid] = subject
+    return uid
@@ -0,0 +1,197 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Worker pools for encoding and decoding blocks.
+#
+# bz2 and PyCrypto's AES release the GIL, so threads already spread them
+# over several cores. Compression can run on a process pool instead, which
+# also takes its Python overhead off the FUSE process, at the cost of
+# copying blocks to the workers. Encryption and decryption always run on
+# threads, where the blocks need no copying.
+
+import collections
+import multiprocessing
+import multiprocessing.pool
+import threading
+
+from Crypto import Random
+
+from imapfs import spool
+
+
+def encode_block(enc, data, compress):
+  """Compress and encrypt a block for storage
+  """
+  data = spool.get_buffer(data)
+  if compress:
+    data = enc.compress(data)
+  return enc.encrypt_message(data)
+
+
+def decode_block(enc, data, compressed):
+  """Decrypt and decompress a stored block
+  """
+  data = enc.decrypt_message(data)
+  if compressed:
+    return enc.decompress(data)
+  return str(data)
+
+
+def compress_block(enc, data):
+  """Compress a block, the first step of encode_block
+  """
+  return enc.compress(spool.get_buffer(data))
+
+
+def encrypt_block(enc, data):
+  """Encrypt a block, the last step of encode_block
+  """
+  return enc.encrypt_message(spool.get_buffer(data))
+
+
+def decrypt_block(enc, data, compressed, copy):
+  """Decrypt a stored block, the first step of decode_block
+  Data that goes on to another process is copied out of the buffer
+  decryption may return, as buffers cannot be sent there.
+  """
+  data = enc.decrypt_message(data)
+  if not compressed or copy:
+    return str(data)
+  return data
+
+
+def decompress_block(enc, data):
+  """Decompress a block, the last step of decode_block
+  """
+  return enc.decompress(data)
+
+
+def init_process():
+  """Set up a worker process
+  """
+  # PyCrypto's random generator must not be shared with the parent
+  Random.atfork()
+
+
+class Done:
+  """A result that is already known, for steps that are skipped
+  """
+
+  def __init__(self, value):
+    self.value = value
+
+  def get(self):
+    return self.value
+
+
+class Pipeline:
+  """Runs block encoding and decoding on pools of workers
+  Compression runs on the compression pool, which is made of processes if
+  processes is set, and encryption on a pool of threads. Each block takes
+  one step on each, and while one block is encrypted the next can be
+  compressed. Results come back in the order the jobs were given. Only one
+  job more than there are workers is in flight in each step, which bounds
+  the memory the jobs hold.
+  """
+
+  def __init__(self, workers, processes=False):
+    self.workers = workers
+    self.processes = processes
+    self.window = workers + 1
+    self.crypto_pool = None
+    self.compress_pool = None
+    self.lock = threading.Lock()
+
+  def get_pools(self):
+    """Get the encryption and compression pools, starting them on first use
+    Starting them late keeps their threads and processes out of the fork
+    FUSE makes when it goes to the background
+    """
+    with self.lock:
+      if self.crypto_pool is None:
+        self.crypto_pool = multiprocessing.pool.ThreadPool(self.workers)
+        if self.processes:
+          self.compress_pool = multiprocessing.Pool(self.workers, init_process)
+        else:
+          self.compress_pool = self.crypto_pool
+      return self.crypto_pool, self.compress_pool
+
+  def run(self, jobs, first, second):
+    """Run two steps on each job
+    first(job) and second(job, result of first) start a step and return
+    its async result. Yields the results of the second steps in order.
+    jobs may be a generator, it is only advanced while there is room in
+    the window.
+    """
+    started = collections.deque()
+    pending = collections.deque()
+    for job in jobs:
+      started.append((job, first(job)))
+      if len(started) >= self.window:
+        job, result = started.popleft()
+        pending.append(second(job, result.get()))
+      if len(pending) >= self.window:
+        yield pending.popleft().get()
+    while started:
+      job, result = started.popleft()
+      pending.append(second(job, result.get()))
+    while pending:
+      yield pending.popleft().get()
+
+  def encode(self, jobs):
+    """Compress and encrypt blocks for storage
+    jobs are (enc, data, compress) tuples, as taken by encode_block
+    """
+    crypto_pool, compress_pool = self.get_pools()
+
+    def compress(job):
+      enc, data, compressed = job
+      if not compressed:
+        return Done(data)
+      return compress_pool.apply_async(compress_block, (enc, data))
+
+    def encrypt(job, data):
+      return crypto_pool.apply_async(encrypt_block, (job[0], data))
+
+    return self.run(jobs, compress, encrypt)
+
+  def decode(self, jobs):
+    """Decrypt and decompress stored blocks
+    jobs are (enc, data, compressed) tuples, as taken by decode_block
+    """
+    crypto_pool, compress_pool = self.get_pools()
+
+    def decrypt(job):
+      enc, data, compressed = job
+      return crypto_pool.apply_async(decrypt_block, (enc, data, compressed, self.processes))
+
+    def decompress(job, data):
+      if not job[2]:
+        return Done(data)
+      return compress_pool.apply_async(decompress_block, (job[0], data))
+
+    return self.run(jobs, decrypt, decompress)
+
+  def close(self):
+    """Stop the workers
+    """
+    with self.lock:
+      if self.crypto_pool is not None:
+        for pool in set([self.crypto_pool, self.compress_pool]):
+          pool.close()
+          pool.join()
+        self.crypto_pool = None
+        self.compress_pool = None
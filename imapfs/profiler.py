@@ -0,0 +1,159 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Sampling profiler for a running mount.
+#
+# While running, a thread takes the stacks of all other threads at a fixed
+# interval. The result is written in the collapsed format that
+# flamegraph.pl reads, one line per distinct stack with its sample count,
+# along with the wall time spent in each FUSE call. When not running, the
+# only cost is one attribute check per FUSE call, in fs.fuse_op.
+
+import os
+import sys
+import threading
+import time
+
+from imapfs.debug_print import debug_print
+
+
+DEFAULT_DURATION = 30
+DEFAULT_INTERVAL = 0.01
+
+
+def format_frame(frame):
+  """Name a stack frame as module:function
+  """
+  module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+  return "%s:%s" % (module, frame.f_code.co_name)
+
+
+class Profiler:
+  """Samples the stacks of all threads for a while
+  Only threads are seen. With pool=processes, the time spent in worker
+  processes shows up as waits in the threads that feed them.
+  """
+
+  def __init__(self, directory, interval=DEFAULT_INTERVAL):
+    self.directory = directory
+    self.interval = interval
+    self.running = False
+    self.lock = threading.Lock()
+    self.end_time = 0
+    self.path = None
+    self.samples = 0
+    self.stacks = {}
+    self.ops = {}
+
+  def start(self, duration=DEFAULT_DURATION):
+    """Start sampling for duration seconds
+    Returns False if already running
+    """
+    with self.lock:
+      if self.running:
+        return False
+      self.running = True
+      self.end_time = time.time() + duration
+      self.samples = 0
+      self.stacks = {}
+      self.ops = {}
+      self.path = os.path.join(self.directory, "imapfs-profile-%d-%s" % (
+          os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+
+    debug_print("Profiling for %ds" % duration)
+    thread = threading.Thread(target=self.run, name="profiler")
+    thread.daemon = True
+    thread.start()
+    return True
+
+  def stop(self):
+    """Stop sampling early
+    The output is still written
+    """
+    self.end_time = 0
+
+  def add_op(self, name, seconds):
+    """Record the wall time of a FUSE call
+    """
+    with self.lock:
+      calls, total, longest = self.ops.get(name, (0, 0.0, 0.0))
+      self.ops[name] = (calls + 1, total + seconds, max(longest, seconds))
+
+  def sample(self):
+    """Add the current stack of every other thread
+    """
+    own_id = threading.current_thread().ident
+    names = dict([(thread.ident, thread.name) for thread in threading.enumerate()])
+    for thread_id, frame in sys._current_frames().items():
+      if thread_id == own_id:
+        continue
+
+      frames = []
+      while frame is not None:
+        frames.append(format_frame(frame))
+        frame = frame.f_back
+      frames.append(names.get(thread_id, "thread-%d" % thread_id))
+      stack = ";".join(reversed(frames))
+      self.stacks[stack] = self.stacks.get(stack, 0) + 1
+    self.samples += 1
+
+  def run(self):
+    """Sample until the time is up, then write the output
+    """
+    try:
+      while time.time() < self.end_time:
+        self.sample()
+        time.sleep(self.interval)
+      self.write()
+    except Exception, e:
+      debug_print("Profiling failed: %s" % e)
+    finally:
+      self.running = False
+
+  def write(self):
+    """Write the stacks to path.folded and the FUSE call times to path.ops
+    """
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory, 0700)
+
+    f = open(self.path + ".folded", "w")
+    try:
+      for stack, count in sorted(self.stacks.items()):
+        f.write("%s %d\n" % (stack, count))
+    finally:
+      f.close()
+
+    with self.lock:
+      ops = sorted(self.ops.items(), key=lambda item: -item[1][1])
+    f = open(self.path + ".ops", "w")
+    try:
+      f.write("op calls total_s mean_ms max_ms\n")
+      for name, (calls, total, longest) in ops:
+        f.write("%s %d %.3f %.3f %.3f\n" % (name, calls, total, total / calls * 1000, longest * 1000))
+    finally:
+      f.close()
+
+    debug_print("Wrote %d samples to %s.folded" % (self.samples, self.path))
+
+  def format_status(self):
+    """Describe what the profiler is doing
+    """
+    if self.running:
+      return "running, %d samples, %ds left, output %s.folded\n" % (
+          self.samples, max(self.end_time - time.time(), 0), self.path)
+    if self.path:
+      return "stopped, last output %s.folded\n" % self.path
+    return "stopped\n"
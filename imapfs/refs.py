@@ -0,0 +1,99 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Reference counts of blocks shared between files by clones.
+#
+# A clone gets a manifest of its own that lists the same blocks as the
+# original. Shared blocks are never changed in place: a file that writes to
+# one stores its changes under a new name and drops its reference.
+
+import exceptions
+
+from imapfs import message
+
+
+REFS = "imapfs-refs"
+
+
+class RefTable:
+  """Counts the files that list each block
+  Only blocks listed by more than one file are stored, all others have one
+  reference. Added references are written before the manifests that list
+  them, and dropped ones after the manifests that stopped listing them, so
+  a crash can only leave counts too high. fsck corrects them.
+  """
+
+  def __init__(self, msg, counts):
+    self.message = msg
+    self.counts = counts
+    self.dirty = False
+
+  def is_shared(self, block_key):
+    """Check if more than one file lists a block
+    """
+    return self.counts.get(block_key, 1) > 1
+
+  def add(self, block_key):
+    """Add a reference to a block
+    """
+    self.counts[block_key] = self.counts.get(block_key, 1) + 1
+    self.dirty = True
+
+  def release(self, block_key):
+    """Drop a reference to a block
+    Returns True if it was the last one
+    """
+    if block_key not in self.counts:
+      return True
+
+    count = self.counts.pop(block_key) - 1
+    if count > 1:
+      self.counts[block_key] = count
+    self.dirty = True
+    return False
+
+  def flush(self):
+    """Write the changes to the server
+    """
+    if self.dirty:
+      self.message.truncate(0)
+      self.message.write("r\r\n")
+      for block_key, count in self.counts.items():
+        self.message.write("%s\t%d\r\n" % (block_key, count))
+      self.message.flush()
+      self.dirty = False
+
+  @staticmethod
+  def load(conn, data=None):
+    """Load the table
+    data is the table's message as saved in a snapshot, if any. Filesystems
+    without shared blocks have none, and get an empty one.
+    """
+    if data is not None:
+      msg = message.Message(conn, REFS, data)
+    else:
+      try:
+        msg = message.Message.open(conn, REFS)
+      except exceptions.IOError:
+        msg = message.Message(conn, REFS, "")
+
+    counts = {}
+    for line in str(msg.data).split("\r\n")[1:]:
+      if not line:
+        continue
+      line_info = line.split("\t")
+      counts[line_info[0]] = int(line_info[1])
+    return RefTable(msg, counts)
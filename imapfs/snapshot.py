@@ -0,0 +1,125 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import os
+
+from imapfs.debug_print import debug_print
+
+
+class Snapshot:
+  """Local copy of the filesystem metadata
+  Holds the data of every known node message and the subject to UID map,
+  along with the mailbox state they are valid for. Stored encrypted.
+  """
+
+  def __init__(self, path, enc):
+    self.path = path
+    self.enc = enc
+    self.nodes = {}
+    self.uids = {}
+
+  def get_node(self, name):
+    """Get the stored data of a node
+    Returns None if the node is not in the snapshot
+    """
+    return self.nodes.get(name)
+
+  def update_node(self, name, data):
+    """Store the data of a node
+    """
+    self.nodes[name] = str(data)
+
+  def forget_node(self, name):
+    """Remove a deleted node
+    """
+    if name in self.nodes:
+      self.nodes.pop(name)
+
+  def load(self, conn):
+    """Load the snapshot and check it against the server
+    Returns True if the mailbox has not changed since the snapshot was saved.
+    The snapshot file is consumed, so a crash before the next save
+    never leaves a stale snapshot behind.
+    """
+    try:
+      f = open(self.path, "rb")
+    except IOError:
+      return False
+
+    try:
+      data = f.read()
+    finally:
+      f.close()
+      os.unlink(self.path)
+
+    try:
+      state, nodes, uids = self.parse(str(self.enc.decrypt_message(data)))
+    except Exception:
+      debug_print("Ignoring unreadable snapshot %s" % self.path)
+      return False
+
+    if state != conn.get_state():
+      debug_print("Mailbox changed, ignoring snapshot")
+      return False
+
+    self.nodes = nodes
+    self.uids = uids
+    conn.uid_cache.update(uids)
+    debug_print("Loaded snapshot of %d nodes" % len(nodes))
+    return True
+
+  def save(self, conn):
+    """Save the snapshot along with the current mailbox state
+    """
+    state = conn.get_state()
+    lines = ["s", "\t".join([item or "" for item in state])]
+    for subject, uid in conn.uid_cache.items():
+      lines.append("u\t%s\t%s" % (subject, uid))
+    for name, data in self.nodes.items():
+      lines.append("n\t%s\t%s" % (name, binascii.b2a_base64(data).strip()))
+
+    directory = os.path.dirname(self.path)
+    if not os.path.isdir(directory):
+      os.makedirs(directory, 0700)
+
+    tmp_path = self.path + ".tmp"
+    f = open(tmp_path, "wb")
+    try:
+      f.write(self.enc.encrypt_message("\r\n".join(lines)))
+    finally:
+      f.close()
+    os.rename(tmp_path, self.path)
+
+  @staticmethod
+  def parse(data):
+    """Parse decrypted snapshot data
+    Returns the state, nodes and uids
+    """
+    lines = data.split("\r\n")
+    if lines[0] != "s":
+      raise ValueError("Not a snapshot")
+    state = tuple([item or None for item in lines[1].split("\t")])
+
+    nodes = {}
+    uids = {}
+    for line in lines[2:]:
+      line_info = line.split("\t")
+      if line_info[0] == "u":
+        uids[line_info[1]] = line_info[2]
+      elif line_info[0] == "n":
+        nodes[line_info[1]] = binascii.a2b_base64(line_info[2])
+    return state, nodes, uids
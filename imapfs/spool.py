@@ -0,0 +1,120 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Block buffers kept in memory-mapped files in a local spool directory.
+#
+# Pages of such buffers belong to the page cache rather than the process
+# heap, so the kernel can write them out under memory pressure instead of
+# the process growing.
+
+import mmap
+import os
+import tempfile
+
+
+# Bytes handled per step when scanning a buffer
+SCAN_SIZE = 65536
+
+
+def get_buffer(data):
+  """Get something bz2 and PyCrypto can read from block data
+  """
+  if isinstance(data, SpoolBuffer):
+    return data.view(0, len(data))
+  return data
+
+
+class SpoolBuffer(object):
+  """Growable byte buffer kept in a memory-mapped file
+  Supports the parts of bytearray that Message uses. The file is unlinked
+  as soon as it is created, so it goes away with the buffer, even if
+  imapfs is killed.
+  """
+
+  def __init__(self, directory, data=""):
+    fd, path = tempfile.mkstemp(prefix="block-", dir=directory)
+    try:
+      os.unlink(path)
+      # An empty file cannot be mapped, so at least one byte is
+      os.ftruncate(fd, max(len(data), 1))
+      self.map = mmap.mmap(fd, max(len(data), 1))
+    finally:
+      # The map keeps a descriptor of its own
+      os.close(fd)
+    self.size = 0
+
+    self += data
+
+  def resize(self, size):
+    """Change the size. New bytes are zero.
+    """
+    # Bytes left over from a shrink within the mapping must not come back
+    if size > self.size and self.size < len(self.map):
+      end = min(size, len(self.map))
+      self.map[self.size:end] = "\0" * (end - self.size)
+
+    self.map.resize(max(size, 1))
+    self.size = size
+
+  def view(self, start, size):
+    """Get a read-only view of part of the buffer, without copying it
+    """
+    start = min(start, self.size)
+    return buffer(self.map, start, min(size, self.size - start))
+
+  def count(self, sub):
+    """Count the occurrences of the single byte sub
+    """
+    total = 0
+    for offset in range(0, self.size, SCAN_SIZE):
+      total += self.map[offset:min(offset + SCAN_SIZE, self.size)].count(sub)
+    return total
+
+  def __len__(self):
+    return self.size
+
+  def __getitem__(self, key):
+    start, stop, step = key.indices(self.size)
+    return self.map[start:max(start, stop)]
+
+  def __setitem__(self, key, value):
+    start, stop, step = key.indices(self.size)
+    if isinstance(value, memoryview):
+      value = value.tobytes()
+    elif not isinstance(value, (str, buffer)):
+      value = str(value)
+    if len(value) != stop - start:
+      raise ValueError("SpoolBuffer slices cannot change size")
+
+    self.map.seek(start)
+    self.map.write(value)
+
+  def __delitem__(self, key):
+    start, stop, step = key.indices(self.size)
+    if stop != self.size:
+      raise ValueError("Only the end of a SpoolBuffer can be deleted")
+    self.resize(start)
+
+  def __iadd__(self, data):
+    start = self.size
+    self.resize(start + len(data))
+    self[start:start + len(data)] = data
+    return self
+
+  def __reduce__(self):
+    # Worker processes get the contents as a str. Only new-style classes
+    # can choose what they unpickle as.
+    return (str, (self[:],))
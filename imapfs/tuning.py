@@ -0,0 +1,151 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Chooses the block size, compression and number of workers from
+# measurements of the server: once at mount time with a scratch message,
+# then again from the transfers the mount makes.
+
+import math
+import multiprocessing
+import time
+import uuid
+
+from Crypto.Random import get_random_bytes
+
+from imapfs import metrics, pipeline
+
+
+# Extensions that are looked for and logged
+CAPABILITIES = ("BINARY", "MULTIAPPEND", "CONDSTORE", "UIDPLUS", "LITERAL+")
+
+# Size of the scratch message
+PROBE_SIZE = 262144
+
+# Block sizes are powers of two in this range. A block should take about
+# BLOCK_ROUND_TRIPS round trips to transfer, so that the cost of each
+# message stays small without making small writes upload too much.
+MIN_BLOCK_SIZE = 65536
+MAX_BLOCK_SIZE = 4194304
+BLOCK_ROUND_TRIPS = 8
+
+# Seconds between updates from live statistics, and the number of
+# transfers of each kind needed for one
+ADAPT_INTERVAL = 60
+MIN_SAMPLES = 10
+
+
+def time_call(func, *args):
+  """Call func
+  Returns its result and how long it took
+  """
+  start_time = time.time()
+  result = func(*args)
+  return result, time.time() - start_time
+
+
+def probe(conn, enc):
+  """Measure the server behind conn
+  Stores, fetches and deletes a scratch message. Returns a Profile.
+  """
+  conns = conn.get_connections()
+  capabilities = [name for name in CAPABILITIES
+                  if all([c.has_capability(name) for c in conns])]
+
+  # The fastest of a few STATUS commands is the round trip
+  round_trip = min([time_call(conns[0].get_state)[1] for i in range(3)])
+
+  # Encoding speeds, on data that does not compress
+  sample = get_random_bytes(PROBE_SIZE)
+  encode_rates = {}
+  for compress in (True, False):
+    encoded, seconds = time_call(pipeline.encode_block, enc, sample, compress)
+    encode_rates[compress] = PROBE_SIZE / max(seconds, 0.000001)
+    if not compress:
+      scratch = encoded
+
+  subject = "imapfs-probe-%s" % uuid.uuid4().hex
+  seconds = time_call(conn.put_message, subject, scratch, False)[1]
+  append_rate = len(scratch) / max(seconds - round_trip, 0.000001)
+
+  uid = conn.get_uid_by_subject(subject)
+  seconds = time_call(conn.get_message, uid, False)[1]
+  fetch_rate = len(scratch) / max(seconds - round_trip, 0.000001)
+  # Remove the scratch message at once, so it does not stay behind for fsck
+  conn.delete_message(uid)
+  conn.expunge([uid])
+
+  return Profile(capabilities, round_trip, append_rate, fetch_rate, encode_rates)
+
+
+class Profile:
+  """Measurements of a server and the parameters chosen for them
+  """
+
+  def __init__(self, capabilities, round_trip, append_rate, fetch_rate, encode_rates, cpus=None):
+    self.capabilities = capabilities
+    self.round_trip = round_trip
+    self.append_rate = append_rate
+    self.fetch_rate = fetch_rate
+    self.encode_rates = encode_rates
+    self.cpus = cpus or multiprocessing.cpu_count()
+    self.choose()
+
+  def choose(self):
+    """Choose the parameters from the measurements
+    """
+    bandwidth = min(self.append_rate, self.fetch_rate)
+
+    target = bandwidth * self.round_trip * BLOCK_ROUND_TRIPS
+    self.block_size = MIN_BLOCK_SIZE
+    while self.block_size * 2 <= min(target, MAX_BLOCK_SIZE):
+      self.block_size *= 2
+
+    # Compress unless it cannot keep up with the network
+    self.compress = self.encode_rates[True] * self.cpus >= bandwidth
+
+    # Encode on workers once it takes a noticeable part of each transfer
+    busy = bandwidth / self.encode_rates[self.compress]
+    if busy < 0.25:
+      self.workers = 0
+    else:
+      self.workers = min(self.cpus, max(1, int(math.ceil(busy))))
+
+  def update(self):
+    """Update the measurements from live statistics
+    Returns True if the chosen parameters changed
+    """
+    round_trip = metrics.get_tracker("round_trip").percentile(0.5, MIN_SAMPLES)
+    append_rate = metrics.get_tracker("append_rate").percentile(0.5, MIN_SAMPLES)
+    fetch_rate = metrics.get_tracker("fetch_rate").percentile(0.5, MIN_SAMPLES)
+
+    old = (self.block_size, self.compress, self.workers)
+    if round_trip is not None:
+      self.round_trip = round_trip
+    if append_rate is not None:
+      self.append_rate = append_rate
+    if fetch_rate is not None:
+      self.fetch_rate = fetch_rate
+    self.choose()
+    return (self.block_size, self.compress, self.workers) != old
+
+  def format(self):
+    """Describe the profile in one line
+    """
+    return ("round trip %.1fms, append %.0fKB/s, fetch %.0fKB/s, capabilities %s: "
+            "block size %dKB, compress %s, %d workers" % (
+                self.round_trip * 1000, self.append_rate / 1024, self.fetch_rate / 1024,
+                " ".join(self.capabilities) or "none",
+                self.block_size / 1024, "on" if self.compress else "off", self.workers))
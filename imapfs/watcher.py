@@ -0,0 +1,123 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Watches the mailboxes of a filesystem for changes made by the client that
+# has it mounted read-write, so that read-only mounts know what to drop
+# from their caches.
+
+import Queue
+import threading
+import time
+
+from imapfs import metrics
+from imapfs.debug_print import debug_print
+
+
+class Watcher:
+  """Reports the subjects of messages that another client changed
+  One thread watches each mailbox. It waits with IDLE where the server
+  supports it and polls otherwise, then lists the messages added since it
+  last looked. Every update of a node or block adds a message, so their
+  subjects are what changed. Changes that cannot be pinned to subjects,
+  such as expunges or a new UIDVALIDITY, are reported as None.
+
+  conn must be a connection of its own, as IDLE ties it up.
+  """
+
+  def __init__(self, conn, interval):
+    self.conns = conn.get_connections()
+    self.interval = interval
+    self.states = [c.get_state() for c in self.conns]
+    self.changes = Queue.Queue()
+    self.started = False
+
+  def start(self):
+    """Start the watching threads, if not started yet
+    Starting them late keeps them out of the fork FUSE makes when it goes
+    to the background
+    """
+    if self.started:
+      return
+    self.started = True
+    for index in range(len(self.conns)):
+      thread = threading.Thread(target=self.watch, args=(index,))
+      thread.daemon = True
+      thread.start()
+
+  def get_changes(self):
+    """Get the subjects changed since the last call
+    A None in the list means that anything may have changed
+    """
+    self.start()
+    changes = []
+    while True:
+      try:
+        changes.append(self.changes.get_nowait())
+      except Queue.Empty:
+        return changes
+
+  def wait(self, conn):
+    """Wait for the mailbox to change, or for the poll interval to pass
+    """
+    if conn.has_capability("IDLE"):
+      conn.idle(self.interval)
+    else:
+      time.sleep(self.interval)
+
+  def watch(self, index):
+    """Watch one mailbox, forever
+    """
+    conn = self.conns[index]
+    while True:
+      try:
+        self.wait(conn)
+        self.check(index)
+      except Exception, e:
+        # Changes may have been missed while the connection was down
+        debug_print("Watching %s failed: %s" % (conn.mailbox, e))
+        metrics.add("watch_errors")
+        self.changes.put(None)
+        time.sleep(self.interval)
+        try:
+          self.states[index] = conn.get_state()
+        except Exception:
+          pass
+
+  def check(self, index):
+    """Queue the changes to a mailbox since it was last checked
+    """
+    conn = self.conns[index]
+    state = self.states[index]
+    new_state = conn.get_state()
+    if new_state == state:
+      return
+
+    uidvalidity, uidnext, count = state[0:3]
+    new_uidvalidity, new_uidnext, new_count = new_state[0:3]
+    if new_uidvalidity != uidvalidity:
+      # Every UID is different
+      self.changes.put(None)
+    else:
+      # Messages added after the new state was read are left for next time
+      added = [subject for uid, subject in conn.get_new_messages(int(uidnext) - 1)
+               if int(uid) < int(new_uidnext)]
+      for subject in added:
+        self.changes.put(subject)
+
+      # Fewer messages than were added means some were expunged
+      if int(new_count) < int(count) + len(added):
+        self.changes.put(None)
+    self.states[index] = new_state
@@ -0,0 +1,99 @@
+# IMAPFS - Cloud storage via IMAP
+# Copyright (C) 2013 Wes Weber
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import imaplib
+import unittest
+
+from imapfs import imapconnection
+
+
+class FakeServer:
+  """Stands in for imaplib.IMAP4_SSL
+  Like Dovecot, it lists CONDSTORE and UIDPLUS only after login
+  """
+
+  def __init__(self, host, port):
+    self.capabilities = ("IMAP4REV1", "AUTH=PLAIN")
+    self.logged_in = False
+    self.commands = []
+    self.sock = self
+
+  def settimeout(self, timeout):
+    pass
+
+  def shutdown(self):
+    pass
+
+  def login(self, user, passwd):
+    self.logged_in = True
+    return "OK", ["Logged in"]
+
+  def capability(self):
+    if self.logged_in:
+      return "OK", ["IMAP4rev1 CONDSTORE UIDPLUS IDLE"]
+    return "OK", ["IMAP4rev1 AUTH=PLAIN"]
+
+  def select(self, mailbox):
+    return "OK", ["0"]
+
+  def response(self, code):
+    return code, ["1"]
+
+  def status(self, mailbox, items):
+    self.commands.append(("STATUS", items))
+    return "OK", ["%s (UIDVALIDITY 1 UIDNEXT 3 MESSAGES 2 HIGHESTMODSEQ 9)" % mailbox]
+
+  def uid(self, command, *args):
+    self.commands.append((command,) + args)
+    return "OK", [None]
+
+  def expunge(self):
+    self.commands.append(("EXPUNGE",))
+    return "OK", [None]
+
+
+class CapabilityTest(unittest.TestCase):
+
+  def setUp(self):
+    self.imap4_ssl = imaplib.IMAP4_SSL
+    imaplib.IMAP4_SSL = FakeServer
+    self.conn = imapconnection.IMAPConnection("localhost", 993, None)
+
+  def tearDown(self):
+    imaplib.IMAP4_SSL = self.imap4_ssl
+
+  def test_login_loads_capabilities(self):
+    self.assertFalse(self.conn.has_capability("UIDPLUS"))
+    self.conn.login("user", "passwd")
+    self.assertTrue(self.conn.has_capability("UIDPLUS"))
+    self.assertTrue(self.conn.has_capability("CONDSTORE"))
+
+  def test_reconnect_loads_capabilities(self):
+    self.conn.login("user", "passwd")
+    self.conn.select("INBOX")
+    self.conn.reconnect()
+    self.assertTrue(self.conn.has_capability("CONDSTORE"))
+    self.assertEqual(self.conn.get_state()[3], "9")
+
+  def test_expunge_only_given_uids(self):
+    self.conn.login("user", "passwd")
+    self.conn.select("INBOX")
+    self.conn.expunge(["4"])
+    self.assertEqual(self.conn.conn.commands, [("EXPUNGE", "4")])
+
+
+if __name__ == "__main__":
+  unittest.main()